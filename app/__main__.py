@@ -0,0 +1,9 @@
+# Ponto de entrada da aplicação: python app
+#
+# Os workers de mineração e de auditoria são iniciados por forkserver e
+# reimportam o módulo principal; este arquivo é o único que eles pulam, então
+# a conexão com o MongoDB e a carga da blockchain (feitas na importação de
+# app.py) acontecem só no processo da aplicação.
+from app import executar
+
+executar()
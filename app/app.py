@@ -1,13 +1,25 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, stream_with_context
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
-from pymongo import GEOSPHERE
+from pymongo import GEOSPHERE, ASCENDING
+from bson import ObjectId
+from bson.errors import InvalidId
+import base64
 import math
+import codecs
+import contextlib
+import copy
 import os
 import datetime
 import json
+import queue
+import re
 from dotenv import load_dotenv
-from establishment_blockchain import EstablishmentBlockchain, Block
+from establishment_blockchain import get_blockchain
+from spatial_index import SpatialIndex, DISTANCIA_MINIMA_KM
+from bulk_import import detectar_formato, ler_linhas, importar_estabelecimentos
+from response_cache import ResponseCache
+from geojson_stream import stream_feature_collection, TAMANHO_LOTE_STREAM
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -23,6 +35,7 @@ def add_cors_headers(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
+    response.headers.add('Access-Control-Expose-Headers', 'X-Next-Cursor')
     return response
 
 # Conectar MongoDB
@@ -52,7 +65,31 @@ try:
     colecao.create_index([('localizacao', GEOSPHERE)])
     print("Índice geoespacial criado com sucesso!")
     
+    # Índice para as buscas por nome e a paginação em ordem alfabética
+    colecao.create_index([('nome', ASCENDING), ('_id', ASCENDING)])
+    
+    # Respostas das APIs dos mapas, descartadas a cada alteração na coleção
+    # vista por este processo e, no máximo, a cada RESPOSTAS_CACHE_TTL segundos
+    cache_respostas = ResponseCache(int(os.getenv('RESPOSTAS_CACHE_TAMANHO', 256)),
+                                    float(os.getenv('RESPOSTAS_CACHE_TTL', 30)))
+    
+    # Índice espacial em memória para a regra dos 2km e as buscas por raio;
+    # toda alteração que ele recebe (rotas, importação, change stream) invalida o cache
+    indice_espacial = SpatialIndex(
+        colecao,
+        tamanho_celula_km=float(os.getenv('ESTABELECIMENTOS_GRID_KM', 2)),
+        intervalo_recarga=float(os.getenv('ESTABELECIMENTOS_INDEX_REFRESH', 0)),
+        ao_alterar=cache_respostas.invalidate
+    )
+    indice_espacial.load()
+    if os.getenv('ESTABELECIMENTOS_CHANGE_STREAM', 'false').lower() == 'true':
+        indice_espacial.watch_changes()
+    
     print("Conectado com sucesso ao MongoDB!")
+    
+    # Carregar a blockchain uma única vez; as requisições só buscam blocos novos
+    get_blockchain()
+    print("Blockchain carregada com sucesso!")
 except Exception as e:
     print(f"Erro detalhado de conexão com MongoDB: {str(e)}")
     print(f"Tipo do erro: {type(e).__name__}")
@@ -61,22 +98,224 @@ except Exception as e:
     print(traceback.format_exc())
     raise e
 
-# Fórmula de Haversine para calcular distância entre dois pontos em km
-def calcular_distancia(lat1, lon1, lat2, lon2):
-    R = 6371  # Raio da Terra em quilômetros
-    
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-    
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
-    
-    a = math.sin(dlat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    
-    return R * c
+# Modo das buscas por raio: 'indice' (memória) ou 'geonear' (agregação no MongoDB)
+MODO_BUSCA_PROXIMOS = os.getenv('BUSCA_PROXIMOS_MODO', 'indice').lower()
+# Máximo de resultados por página nas buscas por raio
+LIMITE_RESULTADOS_PROXIMOS = 1000
+
+def buscar_no_raio(nome, raio_km, limite=0, pular=0):
+    """Estabelecimentos a até `raio_km` do estabelecimento `nome`, do mais próximo ao mais distante.
+
+    Retorna None se o estabelecimento não existir; senão uma lista de dicts com
+    nome, latitude, longitude e distancia (km, 2 casas). `limite` 0 = sem limite.
+    """
+    if MODO_BUSCA_PROXIMOS == 'geonear':
+        return buscar_no_raio_geonear(nome, raio_km, limite, pular)
+    
+    coordenadas = indice_espacial.get_by_name(nome)
+    if not coordenadas:
+        return None
+    resultados = indice_espacial.within(*coordenadas, raio_km, excluir_nome=nome)
+    resultados = resultados[pular:pular + limite] if limite else resultados[pular:]
+    for proximo in resultados:
+        proximo['distancia'] = round(proximo['distancia'], 2)  # Arredondar para 2 casas decimais
+    return resultados
+
+def buscar_no_raio_geonear(nome, raio_km, limite=0, pular=0):
+    """Mesma busca com $geoNear: o MongoDB calcula a distância e devolve só os campos usados"""
+    estabelecimento = colecao.find_one({'nome': nome}, {'_id': 0, 'localizacao': 1})
+    if not estabelecimento:
+        return None
+    pipeline = [
+        {'$geoNear': {
+            'near': estabelecimento['localizacao'],
+            'distanceField': 'distancia',
+            'distanceMultiplier': 0.001,  # metros para km
+            'maxDistance': raio_km * 1000,
+            'spherical': True,
+            'query': {'nome': {'$ne': nome}}  # Excluir o próprio estabelecimento
+        }},
+        {'$project': {
+            '_id': 0,
+            'nome': 1,
+            'latitude': 1,
+            'longitude': 1,
+            'distancia': {'$round': ['$distancia', 2]}
+        }}
+    ]
+    if pular:
+        pipeline.append({'$skip': pular})
+    if limite:
+        pipeline.append({'$limit': limite})
+    return list(colecao.aggregate(pipeline))
+
+def paginacao_proximos(formulario):
+    """Lê `limite` e `pular` do formulário, limitando o tamanho da página.
+
+    Lança ValueError se algum deles não for um inteiro não negativo.
+    """
+    try:
+        limite = int(formulario.get('limite', 0) or 0)
+        pular = int(formulario.get('pular', 0) or 0)
+        if limite < 0 or pular < 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError('Paginação inválida: limite e pular devem ser inteiros não negativos') from None
+    return min(limite, LIMITE_RESULTADOS_PROXIMOS), pular
+
+# Estabelecimentos por página nas listagens e APIs
+ESTABELECIMENTOS_POR_PAGINA = 100
+LIMITE_ESTABELECIMENTOS_POR_PAGINA = 1000
+# Campos usados pelas listagens e pelos mapas
+PROJECAO_ESTABELECIMENTO = {'nome': 1, 'latitude': 1, 'longitude': 1}
+
+def codificar_cursor(documento, ordem):
+    """Cursor opaco que aponta para depois do documento na ordem informada"""
+    chave = [documento.get('nome'), str(documento['_id'])] if ordem == 'nome' else [str(documento['_id'])]
+    return base64.urlsafe_b64encode(json.dumps(chave).encode()).decode().rstrip('=')
+
+def filtro_do_cursor(cursor, ordem):
+    """Filtro dos documentos posteriores ao cursor; ValueError se o cursor for inválido"""
+    try:
+        chave = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if ordem == 'nome':
+            nome, identificador = chave
+            identificador = ObjectId(identificador)
+            return {'$or': [{'nome': {'$gt': nome}}, {'nome': nome, '_id': {'$gt': identificador}}]}
+        identificador, = chave
+        return {'_id': {'$gt': ObjectId(identificador)}}
+    except (ValueError, TypeError, InvalidId):
+        raise ValueError('Cursor inválido')
+
+def pagina_estabelecimentos(args):
+    """Uma página de estabelecimentos por keyset, sem percorrer a coleção inteira.
+
+    Parâmetros lidos de `args`: `ordem` ('_id' ou 'nome'), `depois` (cursor
+    devolvido pela página anterior), `limite` e `prefixo` (início do nome,
+    implica ordem por nome). Retorna (documentos, cursor da próxima página ou
+    None); lança ValueError se o cursor for inválido.
+    """
+    prefixo = args.get('prefixo')
+    ordem = 'nome' if prefixo or args.get('ordem') == 'nome' else '_id'
+    limite = args.get('limite', ESTABELECIMENTOS_POR_PAGINA, type=int)
+    limite = min(max(limite, 1), LIMITE_ESTABELECIMENTOS_POR_PAGINA)
+    
+    filtros = []
+    if args.get('depois'):
+        filtros.append(filtro_do_cursor(args['depois'], ordem))
+    if prefixo:
+        # Expressão ancorada no início: usa o índice por nome
+        filtros.append({'nome': {'$regex': '^' + re.escape(prefixo)}})
+    filtro = filtros[0] if len(filtros) == 1 else {'$and': filtros} if filtros else {}
+    ordenacao = [('nome', ASCENDING), ('_id', ASCENDING)] if ordem == 'nome' else [('_id', ASCENDING)]
+    
+    # Um documento a mais indica se existe próxima página
+    documentos = list(colecao.find(filtro, PROJECAO_ESTABELECIMENTO).sort(ordenacao).limit(limite + 1))
+    if len(documentos) > limite:
+        return documentos[:limite], codificar_cursor(documentos[limite - 1], ordem)
+    return documentos, None
+
+def chave_da_pagina(args):
+    return tuple(args.get(nome) for nome in ('ordem', 'depois', 'limite', 'prefixo'))
+
+def pagina_em_cache(args):
+    """Página de pagina_estabelecimentos compartilhada pelas APIs até a próxima alteração"""
+    return cache_respostas.get(('pagina',) + chave_da_pagina(args), lambda: pagina_estabelecimentos(args))
+
+def resposta_json_em_cache(chave, gerar):
+    """Resposta JSON codificada uma única vez por versão da coleção, com ETag.
+
+    `gerar()` só é chamado sem o corpo em cache; se o If-None-Match do cliente
+    corresponder ao ETag a resposta é um 304 sem corpo.
+    """
+    corpo, etag = cache_respostas.get_json(chave, lambda: app.json.dumps(gerar()).encode())
+    resposta = app.response_class(corpo, mimetype='application/json')
+    resposta.set_etag(etag)
+    # O navegador sempre revalida: o conteúdo muda junto com a coleção
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta.make_conditional(request)
+
+# A partir deste zoom o mapa recebe os estabelecimentos individuais
+ZOOM_PONTOS_MAPA = int(os.getenv('MAPA_ZOOM_PONTOS', 12))
+# Máximo de pontos individuais por resposta; acima disso os pontos são agrupados
+LIMITE_PONTOS_MAPA = int(os.getenv('MAPA_LIMITE_PONTOS', 2000))
+# Células de agrupamento por bloco de 256px do mapa (células de 64px)
+CELULAS_POR_BLOCO_MAPA = 4
+# Largura máxima em longitude de cada polígono da consulta (menor que um hemisfério)
+LARGURA_MAXIMA_POLIGONO = 90
+
+def poligonos_bbox(oeste, sul, leste, norte):
+    """Polígonos GeoJSON que cobrem o retângulo de latitude/longitude.
+
+    No 2dsphere as arestas são geodésicas e um polígono maior que um
+    hemisfério é interpretado pelo lado menor; por isso o retângulo é
+    dividido em faixas de até 90° de longitude (também na virada do
+    antimeridiano) e as arestas ao longo dos paralelos recebem um vértice a
+    cada grau.
+    """
+    sul, norte = max(sul, -89.9), min(norte, 89.9)
+    if leste - oeste >= 360:
+        faixas = [(-180, 180)]
+    else:
+        largura = leste - oeste
+        oeste = (oeste + 180) % 360 - 180
+        leste = oeste + largura
+        faixas = [(oeste, min(leste, 180))]
+        if leste > 180:
+            faixas.append((-180, leste - 360))
+    poligonos = []
+    for inicio_faixa, fim_faixa in faixas:
+        inicio = inicio_faixa
+        while inicio < fim_faixa:
+            fim = min(inicio + LARGURA_MAXIMA_POLIGONO, fim_faixa)
+            passos = max(1, math.ceil(fim - inicio))
+            longitudes = [inicio + (fim - inicio) * i / passos for i in range(passos + 1)]
+            anel = [[lon, sul] for lon in longitudes] + [[lon, norte] for lon in reversed(longitudes)]
+            anel.append(anel[0])
+            poligonos.append({'type': 'Polygon', 'coordinates': [anel]})
+            inicio = fim
+    return poligonos
+
+def filtro_bbox(oeste, sul, leste, norte):
+    """Filtro $geoWithin (índice 2dsphere de `localizacao`) para o retângulo"""
+    condicoes = [{'localizacao': {'$geoWithin': {'$geometry': poligono}}}
+                 for poligono in poligonos_bbox(oeste, sul, leste, norte)]
+    return condicoes[0] if len(condicoes) == 1 else {'$or': condicoes}
+
+def feature_ponto(latitude, longitude, propriedades):
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': propriedades
+    }
+
+def feature_estabelecimento(estabelecimento):
+    return feature_ponto(estabelecimento['latitude'], estabelecimento['longitude'], {'name': estabelecimento['nome']})
+
+def agrupar_no_mapa(filtro, zoom):
+    """Agrupa os estabelecimentos do filtro em células de grade proporcionais ao zoom"""
+    tamanho = 360 / (2 ** zoom * CELULAS_POR_BLOCO_MAPA)
+    grupos = colecao.aggregate([
+        {'$match': filtro},
+        {'$group': {
+            '_id': {
+                'x': {'$floor': {'$divide': [{'$add': ['$longitude', 180]}, tamanho]}},
+                'y': {'$floor': {'$divide': [{'$add': ['$latitude', 90]}, tamanho]}}
+            },
+            'quantidade': {'$sum': 1},
+            'latitude': {'$avg': '$latitude'},
+            'longitude': {'$avg': '$longitude'},
+            'nome': {'$first': '$nome'}
+        }}
+    ])
+    features = []
+    for grupo in grupos:
+        if grupo['quantidade'] == 1:
+            features.append(feature_ponto(grupo['latitude'], grupo['longitude'], {'name': grupo['nome']}))
+        else:
+            features.append(feature_ponto(grupo['latitude'], grupo['longitude'],
+                                          {'cluster': True, 'count': grupo['quantidade']}))
+    return features
 
 # Converter doc MongoDB para dict
 def converter_para_dict(documento):
@@ -93,6 +332,29 @@ def converter_para_dict(documento):
             resultado[chave] = valor
     return resultado
 
+MENSAGEM_FILA_CHEIA = 'A fila de mineração está cheia. Tente cadastrar novamente em instantes.'
+
+def registrar_na_blockchain(estabelecimento_id, nome, latitude, longitude):
+    """Envia o estabelecimento recém-inserido para mineração em segundo plano.
+
+    Sem vaga na fila de mineração, desfaz o cadastro (para que possa ser
+    repetido) e retorna False.
+    """
+    establishment_data = {
+        'establishment_id': str(estabelecimento_id),
+        'nome': nome,
+        'latitude': latitude,
+        'longitude': longitude,
+        'timestamp': str(datetime.datetime.now())
+    }
+    try:
+        get_blockchain().add_establishment_async(establishment_data)
+    except queue.Full:
+        colecao.delete_one({'_id': estabelecimento_id})
+        indice_espacial.remove(estabelecimento_id)
+        return False
+    return True
+
 # Rota da página inicial
 @app.route('/')
 def index():
@@ -107,8 +369,7 @@ def cadastrar_estabelecimento():
         longitude = float(request.form.get('longitude'))
         
         # Verificar se já existe um estabelecimento com o mesmo nome
-        existente = colecao.find_one({'nome': nome})
-        if existente:
+        if indice_espacial.name_taken(nome):
             flash('Um estabelecimento com este nome já existe!', 'danger')
             return redirect(url_for('cadastrar_estabelecimento'))
         
@@ -119,16 +380,7 @@ def cadastrar_estabelecimento():
         }
         
         # Verificar distância de todos os outros estabelecimentos (deve ser pelo menos 2km)
-        proximos = colecao.find({
-            'localizacao': {
-                '$near': {
-                    '$geometry': localizacao,
-                    '$maxDistance': 2000  # 2km em metros
-                }
-            }
-        })
-        
-        if len(list(proximos)) > 0:
+        if indice_espacial.occupied_within(latitude, longitude, DISTANCIA_MINIMA_KM):
             flash('Não é possível cadastrar! Existe um estabelecimento a menos de 2km de distância.', 'danger')
             return redirect(url_for('cadastrar_estabelecimento'))
         
@@ -141,17 +393,12 @@ def cadastrar_estabelecimento():
         }
         # Inserir
         result = colecao.insert_one(estabelecimento)
+        indice_espacial.add(result.inserted_id, nome, latitude, longitude)
         
         # Registrar na blockchain de forma assíncrona
-        blockchain = EstablishmentBlockchain()
-        establishment_data = {
-            'establishment_id': str(result.inserted_id),
-            'nome': nome,
-            'latitude': latitude,
-            'longitude': longitude,
-            'timestamp': str(datetime.datetime.now())
-        }
-        blockchain.add_establishment_async(establishment_data)
+        if not registrar_na_blockchain(result.inserted_id, nome, latitude, longitude):
+            flash(MENSAGEM_FILA_CHEIA, 'warning')
+            return render_template('cadastro.html'), 503
         
         flash('Estabelecimento cadastrado com sucesso! A mineração na blockchain foi iniciada em segundo plano.', 'success')
     
@@ -160,21 +407,34 @@ def cadastrar_estabelecimento():
 # Visualizar todos os estabelecimentos
 @app.route('/estabelecimentos')
 def listar_estabelecimentos():
-    estabelecimentos_raw = list(colecao.find())
+    try:
+        estabelecimentos_raw, proximo = pagina_estabelecimentos(request.args)
+    except ValueError as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('listar_estabelecimentos'))
     estabelecimentos = [converter_para_dict(e) for e in estabelecimentos_raw]
-    return render_template('estabelecimentos.html', estabelecimentos=estabelecimentos)
+    
+    # Páginas seguintes são carregadas pela própria página: só as linhas da tabela
+    if request.args.get('parcial'):
+        resposta = app.make_response(render_template('estabelecimentos_linhas.html', estabelecimentos=estabelecimentos))
+        resposta.headers['X-Next-Cursor'] = proximo or ''
+        return resposta
+    return render_template('estabelecimentos.html', estabelecimentos=estabelecimentos, proximo=proximo)
 
 # Excluir estabelecimento
 @app.route('/excluir/<nome>', methods=['POST'])
 def excluir_estabelecimento(nome):
-    colecao.delete_one({'nome': nome})
+    excluido = colecao.find_one_and_delete({'nome': nome}, {'_id': 1})
+    if excluido:
+        indice_espacial.remove(excluido['_id'])
     flash('Estabelecimento excluído com sucesso!', 'success')
     return redirect(url_for('listar_estabelecimentos'))
 
 # Verificar status do estabelecimento na blockchain
 @app.route('/verificar-blockchain/<establishment_id>')
 def verificar_blockchain(establishment_id):
-    blockchain = EstablishmentBlockchain()
+    # Uma única consulta ao banco; a validade da chain vem do cache em memória
+    blockchain = get_blockchain()
     status = blockchain.get_establishment_status(establishment_id)
     
     if status['status'] == 'not_found':
@@ -189,81 +449,106 @@ def verificar_blockchain(establishment_id):
 # Buscar estabelecimentos próximos
 @app.route('/busca-proximos', methods=['GET', 'POST'])
 def buscar_proximos():
-    # Converter estabelecimentos para dicionários serializáveis
-    estabelecimentos_raw = list(colecao.find())
-    estabelecimentos = [converter_para_dict(e) for e in estabelecimentos_raw]
-    
+    # A lista de estabelecimentos do formulário é buscada pelo nome digitado
     resultados = []
     estabelecimento_selecionado = None
+    coordenadas_selecionado = None
     raio = 5  # valor padrão
     
     if request.method == 'POST':
         estabelecimento_selecionado = request.form.get('estabelecimento')
         raio = int(request.form.get('raio', 5))
-        estabelecimento_raw = colecao.find_one({'nome': estabelecimento_selecionado})
-        estabelecimento = converter_para_dict(estabelecimento_raw)
+        try:
+            limite, pular = paginacao_proximos(request.form)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return render_template('busca_proximos.html',
+                                  resultados=resultados, estabelecimento_selecionado=estabelecimento_selecionado,
+                                  raio=raio, coordenadas_selecionado=coordenadas_selecionado), 400
         
-        if estabelecimento:
-            localizacao = estabelecimento_raw['localizacao']  # Usar o documento original para consulta
-            
-            # Encontrar estabelecimentos no raio especificado
-            proximos_raw = colecao.find({
-                'nome': {'$ne': estabelecimento_selecionado},  # Excluir o estabelecimento atual
-                'localizacao': {
-                    '$near': {
-                        '$geometry': localizacao,
-                        '$maxDistance': raio * 1000  # converter km para metros
-                    }
-                }
-            })
-            
-            for proximo_raw in proximos_raw:
-                # Converter para dicionário serializável
-                proximo = converter_para_dict(proximo_raw)
-                
-                # Calcular distância exata
-                distancia = calcular_distancia(
-                    estabelecimento['latitude'], estabelecimento['longitude'],
-                    proximo['latitude'], proximo['longitude']
-                )
-                
-                proximo['distancia'] = round(distancia, 2)  # Arredondar para 2 casas decimais
-                resultados.append(proximo)
-    
-    return render_template('busca_proximos.html', estabelecimentos=estabelecimentos, 
+        # Encontrar estabelecimentos no raio especificado, excluindo o atual
+        resultados = buscar_no_raio(estabelecimento_selecionado, raio, limite, pular) or []
+        # Centro do mapa e do círculo do raio
+        coordenadas_selecionado = indice_espacial.get_by_name(estabelecimento_selecionado)
+    
+    return render_template('busca_proximos.html',
                           resultados=resultados, estabelecimento_selecionado=estabelecimento_selecionado,
-                          raio=raio)
+                          raio=raio, coordenadas_selecionado=coordenadas_selecionado)
 
 # API para obter estabelecimentos em formato GeoJSON para visualização no mapa
 @app.route('/api/estabelecimentos')
 def obter_estabelecimentos():
-    # Aqui não precisamos do _id, então podemos excluí-lo diretamente na consulta
-    estabelecimentos = list(colecao.find({}, {
-        '_id': 0,
-        'nome': 1,
-        'latitude': 1,
-        'longitude': 1
-    }))
+    """Uma página da coleção em GeoJSON; `next` é o cursor da página seguinte.
+
+    Com `stream=1` a coleção inteira é transmitida em pedaços, lida do
+    cursor em lotes, sem paginação nem cache.
+    """
+    if request.args.get('stream'):
+        return transmitir_estabelecimentos()
     
-    features = []
-    for e in estabelecimentos:
-        features.append({
-            'type': 'Feature',
-            'geometry': {
-                'type': 'Point',
-                'coordinates': [e['longitude'], e['latitude']]
-            },
-            'properties': {
-                'name': e['nome']
-            }
-        })
-    
-    geojson = {
-        'type': 'FeatureCollection',
-        'features': features
-    }
+    try:
+        estabelecimentos, proximo = pagina_em_cache(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    def geojson():
+        features = [feature_estabelecimento(e) for e in estabelecimentos]
+        
+        return {
+            'type': 'FeatureCollection',
+            'features': features,
+            'next': proximo
+        }
+    
+    return resposta_json_em_cache(('geojson',) + chave_da_pagina(request.args), geojson)
+
+# API para os mapas: apenas o que está na área visível, agrupado conforme o zoom
+@app.route('/api/mapa')
+def api_mapa():
+    """GeoJSON da área `bbox=oeste,sul,leste,norte` no `zoom` do mapa.
+
+    Abaixo de MAPA_ZOOM_PONTOS os estabelecimentos vêm agrupados em células
+    (features com `cluster` e `count`); a partir dele vêm individualmente,
+    enquanto couberem em MAPA_LIMITE_PONTOS.
+    """
+    try:
+        oeste, sul, leste, norte = (float(valor) for valor in request.args['bbox'].split(','))
+        zoom = min(max(request.args.get('zoom', 0, type=int), 0), 24)
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'message': 'Informe bbox=oeste,sul,leste,norte e zoom'}), 400
+    # Em zoom baixo o Leaflet pode informar latitudes além dos polos
+    sul, norte = max(sul, -90), min(norte, 90)
+    if not (math.isfinite(oeste) and math.isfinite(leste) and sul <= norte and oeste <= leste):
+        return jsonify({'success': False, 'message': 'bbox inválido'}), 400
+    
+    def mapa():
+        filtro = filtro_bbox(oeste, sul, leste, norte)
+        agrupado = zoom < ZOOM_PONTOS_MAPA
+        if not agrupado:
+            # Um ponto a mais indica que a área tem pontos demais para mostrar individualmente
+            estabelecimentos = list(colecao.find(filtro, {'_id': 0, 'nome': 1, 'latitude': 1, 'longitude': 1})
+                                    .limit(LIMITE_PONTOS_MAPA + 1))
+            agrupado = len(estabelecimentos) > LIMITE_PONTOS_MAPA
+        if agrupado:
+            # Com pontos demais em zoom alto, usar as células do último nível agrupado
+            features = agrupar_no_mapa(filtro, min(zoom, ZOOM_PONTOS_MAPA - 1))
+        else:
+            features = [feature_estabelecimento(e) for e in estabelecimentos]
+        
+        return {
+            'type': 'FeatureCollection',
+            'features': features,
+            'zoom': zoom,
+            'clustered': agrupado
+        }
     
-    return jsonify(geojson)
+    return resposta_json_em_cache(('mapa', oeste, sul, leste, norte, zoom), mapa)
+
+def transmitir_estabelecimentos():
+    """FeatureCollection de toda a coleção, codificada e enviada à medida que o cursor avança"""
+    cursor = colecao.find({}, {'_id': 0, 'nome': 1, 'latitude': 1, 'longitude': 1}).batch_size(TAMANHO_LOTE_STREAM)
+    return app.response_class(stream_with_context(stream_feature_collection(cursor, feature_estabelecimento)),
+                              mimetype='application/json')
 
 # API endpoint for creating establishments
 @app.route('/api/cadastro', methods=['POST'])
@@ -275,8 +560,7 @@ def api_cadastrar_estabelecimento():
         longitude = float(request.form.get('longitude'))
         
         # Verificar se já existe um estabelecimento com o mesmo nome
-        existente = colecao.find_one({'nome': nome})
-        if existente:
+        if indice_espacial.name_taken(nome):
             return jsonify({'success': False, 'message': 'Um estabelecimento com este nome já existe!'}), 400
         
         # Criar ponto GeoJSON para a localização
@@ -286,16 +570,7 @@ def api_cadastrar_estabelecimento():
         }
         
         # Verificar distância de todos os outros estabelecimentos (deve ser pelo menos 2km)
-        proximos = colecao.find({
-            'localizacao': {
-                '$near': {
-                    '$geometry': localizacao,
-                    '$maxDistance': 2000  # 2km em metros
-                }
-            }
-        })
-        
-        if len(list(proximos)) > 0:
+        if indice_espacial.occupied_within(latitude, longitude, DISTANCIA_MINIMA_KM):
             return jsonify({'success': False, 'message': 'Não é possível cadastrar! Existe um estabelecimento a menos de 2km de distância.'}), 400
         
         # Inserir o novo estabelecimento
@@ -308,17 +583,11 @@ def api_cadastrar_estabelecimento():
         
         # Corrigido: Inserir apenas uma vez
         result = colecao.insert_one(estabelecimento)
+        indice_espacial.add(result.inserted_id, nome, latitude, longitude)
         
         # Registrar na blockchain de forma assíncrona
-        blockchain = EstablishmentBlockchain()
-        establishment_data = {
-            'establishment_id': str(result.inserted_id),
-            'nome': nome,
-            'latitude': latitude,
-            'longitude': longitude,
-            'timestamp': str(datetime.datetime.now())
-        }
-        blockchain.add_establishment_async(establishment_data)
+        if not registrar_na_blockchain(result.inserted_id, nome, latitude, longitude):
+            return jsonify({'success': False, 'message': MENSAGEM_FILA_CHEIA}), 503
         
         return jsonify({'success': True, 'message': 'Estabelecimento cadastrado com sucesso! A mineração na blockchain foi iniciada em segundo plano.'}), 201
     except Exception as e:
@@ -328,8 +597,9 @@ def api_cadastrar_estabelecimento():
 @app.route('/api/excluir/<nome>', methods=['POST', 'DELETE'])
 def api_excluir_estabelecimento(nome):
     try:
-        result = colecao.delete_one({'nome': nome})
-        if result.deleted_count > 0:
+        excluido = colecao.find_one_and_delete({'nome': nome}, {'_id': 1})
+        if excluido:
+            indice_espacial.remove(excluido['_id'])
             return jsonify({'success': True, 'message': f'Estabelecimento {nome} excluído com sucesso!'}), 200
         else:
             return jsonify({'success': False, 'message': 'Estabelecimento não encontrado.'}), 404
@@ -339,211 +609,245 @@ def api_excluir_estabelecimento(nome):
 # API endpoint for finding nearby establishments
 @app.route('/api/busca-proximos', methods=['POST'])
 def api_busca_proximos():
-    resultados = []
     try:
         estabelecimento_nome = request.form.get('estabelecimento')
         raio = float(request.form.get('raio'))
+        try:
+            limite, pular = paginacao_proximos(request.form)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
         
-        # Converter raio de km para metros (para consulta geoespacial)
-        raio_metros = raio * 1000
-        
-        # Buscar estabelecimento selecionado
-        estabelecimento = colecao.find_one({'nome': estabelecimento_nome})
+        # Buscar estabelecimentos próximos (índice em memória ou $geoNear)
+        resultados = buscar_no_raio(estabelecimento_nome, raio, limite, pular)
         
-        if not estabelecimento:
+        if resultados is None:
             return jsonify({'success': False, 'message': 'Estabelecimento não encontrado'}), 404
         
-        # Buscar estabelecimentos próximos usando consulta geoespacial
-        proximos_cursor = colecao.find({
-            'nome': {'$ne': estabelecimento_nome},  # Excluir o próprio estabelecimento
-            'localizacao': {
-                '$near': {
-                    '$geometry': estabelecimento['localizacao'],
-                    '$maxDistance': raio_metros
-                }
-            }
-        })
-        
-        # Processar resultados
-        for proximo in proximos_cursor:
-            # Calcular distância exata
-            distancia = calcular_distancia(
-                estabelecimento['latitude'], estabelecimento['longitude'],
-                proximo['latitude'], proximo['longitude']
-            )
-            
-            resultados.append({
-                'nome': proximo['nome'],
-                'latitude': proximo['latitude'],
-                'longitude': proximo['longitude'],
-                'distancia': round(distancia, 2)  # Arredondar para 2 casas decimais
-            })
-        
         return jsonify({'success': True, 'resultados': resultados}), 200
     except Exception as e:
         return jsonify({'success': False, 'message': f'Erro na busca: {str(e)}'}), 500
 
+# API para importação em lote de estabelecimentos (CSV ou NDJSON)
+@app.route('/api/importar', methods=['POST'])
+def api_importar_estabelecimentos():
+    """Importa o arquivo enviado (campo `arquivo`) ou o corpo da requisição.
+
+    O relatório é transmitido em NDJSON: um evento `linha` por registro,
+    aceito ou rejeitado com o motivo, e um `resumo` no final.
+    """
+    arquivo = request.files.get('arquivo')
+    if arquivo:
+        stream, formato = arquivo.stream, detectar_formato(arquivo.filename, arquivo.mimetype)
+    else:
+        stream, formato = request.stream, detectar_formato(None, request.mimetype)
+    formato = request.args.get('formato', formato)
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'message': 'Formato inválido: use csv ou ndjson'}), 400
+    try:
+        tamanho_lote = int(request.args.get('lote', os.getenv('BULK_IMPORT_BATCH_SIZE', 1000)))
+        if tamanho_lote <= 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Tamanho de lote inválido: use um inteiro positivo'}), 400
+    blockchain = get_blockchain()
+    
+    def gerar():
+        contagem = {'aceito': 0, 'rejeitado': 0}
+        registros = ler_linhas(codecs.iterdecode(stream, 'utf-8-sig'), formato)
+        for resultado in importar_estabelecimentos(registros, colecao, indice_espacial, blockchain, tamanho_lote):
+            contagem[resultado['status']] += 1
+            yield json.dumps({'type': 'linha', **resultado}, ensure_ascii=False) + '\n'
+        yield json.dumps({'type': 'resumo', 'aceitos': contagem['aceito'], 'rejeitados': contagem['rejeitado']}) + '\n'
+    
+    return app.response_class(stream_with_context(gerar()), mimetype='application/x-ndjson')
+
 @app.route('/api/estabelecimentos-geolocalizacao')
 def api_estabelecimentos_geolocalizacao():
-    # Use the existing obter_estabelecimentos function to get GeoJSON data
-    geojson_data = obter_estabelecimentos().json
-    
-    # Convert from GeoJSON to a simpler format for the map
-    estabelecimentos_json = []
-    for feature in geojson_data['features']:
-        estabelecimentos_json.append({
-            'nome': feature['properties']['name'],
-            'latitude': feature['geometry']['coordinates'][1],  # GeoJSON uses [longitude, latitude]
-            'longitude': feature['geometry']['coordinates'][0]
-        })
-    
-    # Return as JSON response
-    return jsonify(estabelecimentos_json)
+    """Uma página da coleção em formato simples; o cursor da próxima vai no cabeçalho X-Next-Cursor"""
+    try:
+        estabelecimentos, proximo = pagina_em_cache(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    def lista():
+        return [{
+            'nome': e['nome'],
+            'latitude': e['latitude'],
+            'longitude': e['longitude']
+        } for e in estabelecimentos]
+    
+    resposta = resposta_json_em_cache(('geolocalizacao',) + chave_da_pagina(request.args), lista)
+    resposta.headers['X-Next-Cursor'] = proximo or ''
+    return resposta
 
 # Blockchain validation routes
+# Blocos por página na listagem da blockchain
+BLOCOS_POR_PAGINA = 50
+LIMITE_BLOCOS_POR_PAGINA = 500
+# Blocos adulterados cujos erros aparecem na página (os demais ficam no relatório)
+LIMITE_ERROS_PAGINA = 100
+
 @app.route('/blockchain-validation')
 def validate_blockchain():
-    blockchain = EstablishmentBlockchain()
-    blocks = []
-    
-    for block in blockchain.chain:
-        blocks.append(block.to_dict())
-    
-    # Check if validation was performed
-    chain_status = session.pop('chain_status', None)
-    validation_errors = session.pop('validation_errors', None)
-    tampered_blocks = session.pop('tampered_blocks', [])
+    blockchain = get_blockchain()
+    blockchain.sync()
+    
+    # Paginação por cursor: blocos com índice maior que `depois`
+    depois = max(request.args.get('depois', -1, type=int), -1)
+    limite = min(max(request.args.get('limite', BLOCOS_POR_PAGINA, type=int), 1), LIMITE_BLOCOS_POR_PAGINA)
+    total_blocos = len(blockchain.chain)
+    blocks = [block.to_dict() for block in blockchain.get_blocks(depois + 1, depois + 1 + limite)]
+    proximo = blocks[-1]['index'] if blocks and blocks[-1]['index'] < total_blocos - 1 else None
+    anterior = max(depois - limite, -1) if depois >= 0 else None
+    
+    # O resultado da última validação fica no MongoDB; a sessão guarda só o id
+    chain_status = None
+    validation_errors = None
+    tampered_blocks = []
+    tampered_count = 0
+    auditoria_id = request.args.get('auditoria') or session.get('auditoria_id')
+    auditoria = blockchain.get_audit(auditoria_id) if auditoria_id else None
+    if auditoria and auditoria.get('status') == 'completed':
+        chain_status = auditoria['valid']
+        tampered_count = auditoria['tampered_count']
+        if not chain_status:
+            validation_errors = []
+            for registro in blockchain.get_audit_errors(auditoria['_id'], limite=LIMITE_ERROS_PAGINA):
+                validation_errors.extend(registro['errors'])
+            if blocks:
+                tampered_blocks = [registro['index'] for registro in blockchain.get_audit_errors(
+                    auditoria['_id'], blocks[0]['index'], blocks[-1]['index'])]
     
     return render_template(
         'blockchain_validation.html', 
         blocks=blocks, 
         chain_status=chain_status,
         validation_errors=validation_errors,
-        tampered_blocks=tampered_blocks
+        tampered_blocks=tampered_blocks,
+        tampered_count=tampered_count,
+        error_limit=LIMITE_ERROS_PAGINA,
+        auditoria_id=str(auditoria['_id']) if auditoria else None,
+        total_blocos=total_blocos,
+        limite=limite,
+        proximo=proximo,
+        anterior=anterior
     )
 
 @app.route('/validate-blockchain', methods=['POST'])
 def perform_blockchain_validation():
-    blockchain = EstablishmentBlockchain()
-    is_valid = blockchain.is_chain_valid()
-    validation_errors = []
-    
-    # If blockchain is invalid, find the specific issues
-    if not is_valid:
-        validation_errors = get_blockchain_validation_errors(blockchain)
-    
-    # Store validation results in session for the redirect
-    session['chain_status'] = is_valid
-    session['validation_errors'] = validation_errors
-    
-    if is_valid:
+    blockchain = get_blockchain()
+    blockchain.sync()
+    # Auditoria completa sob demanda, ignorando o checkpoint de validação
+    resumo = None
+    for evento in blockchain.run_audit():
+        if evento['type'] == 'resumo':
+            resumo = evento
+    
+    # Guardar na sessão apenas o id da auditoria para o redirect
+    session['auditoria_id'] = resumo['auditoria_id']
+    
+    if resumo['valid']:
         flash('Blockchain validada com sucesso! Todos os blocos estão íntegros.', 'success')
     else:
         flash('ALERTA: Foram encontradas inconsistências na blockchain!', 'danger')
     
     return redirect(url_for('validate_blockchain'))
 
-def get_blockchain_validation_errors(blockchain):
-    """Identify specific validation errors in the blockchain"""
-    errors = []
-    tampered_blocks = set()  # Keep track of tampered block indices
-    
-    for i in range(1, len(blockchain.chain)):
-        current_block = blockchain.chain[i]
-        previous_block = blockchain.chain[i-1]
-        
-        block_has_error = False
-        
-        # Check current hash
-        calculated_hash = current_block.calculate_hash()
-        if current_block.hash != calculated_hash:
-            errors.append(f"Bloco #{current_block.index}: Hash calculado não corresponde ao hash armazenado.")
-            tampered_blocks.add(current_block.index)
-            block_has_error = True
-            # Add more detail to help understand the tampering
-            errors.append(f"  - Hash armazenado: {current_block.hash[:10]}...")
-            errors.append(f"  - Hash calculado: {calculated_hash[:10]}...")
-        
-        # Check previous hash
-        if current_block.previous_hash != previous_block.hash:
-            errors.append(f"Bloco #{current_block.index}: Referência ao hash anterior inválida.")
-            tampered_blocks.add(current_block.index)
-            block_has_error = True
-            # Add more detail
-            errors.append(f"  - Hash anterior armazenado: {current_block.previous_hash[:10]}...")
-            errors.append(f"  - Hash do bloco anterior: {previous_block.hash[:10]}...")
-        
-        # Check proof of work
-        if current_block.hash[:blockchain.difficulty] != "0" * blockchain.difficulty:
-            errors.append(f"Bloco #{current_block.index}: Prova de trabalho inválida.")
-            tampered_blocks.add(current_block.index)
-            block_has_error = True
-            # Add more detail
-            errors.append(f"  - Prefixo atual: {current_block.hash[:blockchain.difficulty]}")
-            errors.append(f"  - Prefixo esperado: {'0' * blockchain.difficulty}")
-        
-        # If there was an error, provide info about the block
-        if block_has_error:
-            if isinstance(current_block.establishment_data, dict) and 'nome' in current_block.establishment_data:
-                errors.append(f"  - Nome do estabelecimento: {current_block.establishment_data['nome']}")
-    
-    # Include tampered block indices in session
-    session['tampered_blocks'] = list(tampered_blocks)
-    
-    return errors
+@app.route('/validate-blockchain/stream')
+def stream_blockchain_validation():
+    """Auditoria completa transmitida em NDJSON (um evento JSON por linha)"""
+    blockchain = get_blockchain()
+    blockchain.sync()
+    
+    def gerar():
+        # closing: se o cliente desconectar, a auditoria é encerrada como 'aborted'
+        with contextlib.closing(blockchain.run_audit()) as eventos:
+            for evento in eventos:
+                yield json.dumps(evento, ensure_ascii=False) + '\n'
+    
+    return app.response_class(gerar(), mimetype='application/x-ndjson')
+
+@app.route('/blockchain-audits/<auditoria_id>')
+def blockchain_audit_report(auditoria_id):
+    """Relatório de uma auditoria guardada, com os erros paginados por índice"""
+    blockchain = get_blockchain()
+    auditoria = blockchain.get_audit(auditoria_id)
+    if auditoria is None:
+        return jsonify({'error': 'Auditoria não encontrada'}), 404
+    
+    depois = request.args.get('depois', -1, type=int)
+    limite = min(max(request.args.get('limite', BLOCOS_POR_PAGINA, type=int), 1), LIMITE_BLOCOS_POR_PAGINA)
+    erros = blockchain.get_audit_errors(auditoria['_id'], inicio=depois + 1, limite=limite)
+    for registro in erros:
+        registro['auditoria_id'] = str(registro['auditoria_id'])
+        registro.pop('created_at', None)
+    
+    auditoria['_id'] = str(auditoria['_id'])
+    auditoria.pop('created_at', None)
+    return jsonify({
+        'auditoria': auditoria,
+        'errors': erros,
+        'proximo': erros[-1]['index'] if len(erros) == limite else None
+    })
 
 @app.route('/tamper-block', methods=['POST'])
 def tamper_block():
-    """Tamper with a block to demonstrate blockchain validation"""
-    block_index = int(request.form.get('block_index'))
-    
-    blockchain = EstablishmentBlockchain()
-    
-    # Find and tamper the block
-    if 0 <= block_index < len(blockchain.chain):
-        # Modificar bloco
+    """Tamper with one or more blocks to demonstrate blockchain validation"""
+    block_indices = [int(valor) for valor in request.form.getlist('block_index')]
+    
+    blockchain = get_blockchain()
+    blockchain.sync()
+    
+    # Montar as alterações e gravá-las em lote
+    atualizacoes = {}
+    for block_index in block_indices:
+        if not 0 <= block_index < len(blockchain.chain):
+            flash(f'Índice de bloco inválido: {block_index}.', 'danger')
+            continue
         block = blockchain.chain[block_index]
         
         # Simple tampering: change the establishment name
-        if isinstance(block.establishment_data, dict) and 'nome' in block.establishment_data:
+        tampered_data = None
+        if block.is_batch() and block.establishment_data['establishments']:
+            # Em blocos em lote, adulterar o primeiro registro do lote
+            tampered_data = copy.deepcopy(block.establishment_data)
+            registro = tampered_data['establishments'][0]
+            registro['nome'] = str(registro.get('nome', '')) + " (Adulterado)"
+        elif isinstance(block.establishment_data, dict) and 'nome' in block.establishment_data:
             tampered_data = block.establishment_data.copy()
             tampered_data['nome'] = tampered_data['nome'] + " (Adulterado)"
-            
-            # Atualizar sem recalcular hash
-            blockchain.blockchain_collection.update_one(
-                {'index': block_index},
-                {'$set': {'establishment_data': tampered_data}}
-            )
-            
+        
+        if tampered_data is not None:
+            atualizacoes[block_index] = {'establishment_data': tampered_data}
             flash(f'Bloco #{block_index} foi adulterado para demonstração. Valide a blockchain para ver o resultado.', 'warning')
         else:
-            flash('Não foi possível adulterar este bloco.', 'danger')
-    else:
-        flash('Índice de bloco inválido.', 'danger')
+            flash(f'Não foi possível adulterar o bloco #{block_index}.', 'danger')
+    
+    if atualizacoes:
+        # Atualizar sem recalcular hash
+        blockchain.update_blocks(atualizacoes)
+        session.pop('auditoria_id', None)
     
     return redirect(url_for('validate_blockchain'))
 
 @app.route('/restore-blockchain')
 def restore_blockchain():
     """Restore the blockchain to its original state after tampering"""
-    blockchain = EstablishmentBlockchain()
+    blockchain = get_blockchain()
+    blockchain.sync()
     
-    # Recalcular hash e atualizar cada bloco
-    for i in range(len(blockchain.chain)):
-        block = blockchain.chain[i]
-        original_hash = block.calculate_hash()
-        
-        # Update the hash in MongoDB
-        blockchain.blockchain_collection.update_one(
-            {'index': block.index},
-            {'$set': {'hash': original_hash}}
-        )
+    # Recalcular os hashes e gravar apenas os alterados, em lotes
+    alterados = blockchain.restore_hashes()
+    session.pop('auditoria_id', None)
     
-    flash('Blockchain restaurada ao estado original.', 'success')
+    flash(f'Blockchain restaurada ao estado original ({alterados} blocos atualizados).', 'success')
     return redirect(url_for('validate_blockchain'))
 
-if __name__ == '__main__':
+def executar():
     # Em ambiente Docker, sempre usar 0.0.0.0 como host
     debug_mode = os.getenv('DEBUG', 'false').lower() == 'true'
     port = int(os.getenv('PORT', 5000))
-    app.run(debug=debug_mode, host='0.0.0.0', port=port)
\ No newline at end of file
+    app.run(debug=debug_mode, host='0.0.0.0', port=port)
+
+if __name__ == '__main__':
+    executar()
\ No newline at end of file
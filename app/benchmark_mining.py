@@ -0,0 +1,176 @@
+# Benchmark da mineração: hashes/segundo e tempo até a solução por dificuldade,
+# número de workers e estratégia de execução. Não usa o MongoDB.
+#
+# O pool de cada estratégia/quantidade de workers é criado e aquecido antes
+# das medições; o tempo de inicialização é informado à parte (startup_seconds)
+# e não entra no H/s nem no tempo até a solução.
+#
+# Exemplo:
+#   python app/benchmark_mining.py --difficulties 16 20 --workers 1 4 16 \
+#       --strategies serial threads processos --repeats 5 --output resultados.json
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import statistics
+import time
+
+import mining
+from establishment_blockchain import Block
+
+CAMPOS_EXECUCAO = ['strategy', 'workers', 'difficulty_bits', 'repeat', 'nonce', 'hashes', 'seconds', 'hashes_per_second']
+CAMPOS_RESUMO = ['strategy', 'workers', 'difficulty_bits', 'runs', 'startup_seconds',
+                 'seconds_mean', 'seconds_stdev', 'seconds_min', 'seconds_max',
+                 'hashes_per_second_mean', 'hashes_per_second_stdev']
+
+
+def criar_bloco(repeticao, difficulty_bits):
+    """Cria um bloco determinístico: cada repetição tem um cabeçalho diferente"""
+    establishment_data = {
+        'establishment_id': f'benchmark-{repeticao}',
+        'nome': f'Benchmark {repeticao}',
+        'latitude': -23.5505,
+        'longitude': -46.6333,
+        'timestamp': '2025-01-01 00:00:00'
+    }
+    block = Block(repeticao + 1, f'benchmark-{difficulty_bits}-{repeticao}', establishment_data, '0' * 64)
+    block.difficulty_bits = difficulty_bits
+    return block
+
+
+def iniciar_pool(estrategia, num_workers):
+    """Cria o pool com todos os workers prontos; retorna (pool, segundos de inicialização)"""
+    inicio = time.perf_counter()
+    pool = mining.MiningPool(num_workers, estrategia)
+    pool.aquecer()
+    return pool, round(time.perf_counter() - inicio, 6)
+
+
+def medir(pool, estrategia, num_workers, difficulty_bits, repeticao):
+    """Minera um bloco no pool já aquecido e retorna as medidas da execução"""
+    block = criar_bloco(repeticao, difficulty_bits)
+    estatisticas = {}
+    inicio = time.perf_counter()
+    resultado = pool.minerar(block.header_bytes(), difficulty_bits, estatisticas=estatisticas)
+    segundos = time.perf_counter() - inicio
+
+    nonce = None
+    if resultado:
+        block.nonce, block.hash = resultado
+        # A solução precisa ser a mesma que o Block calcula
+        if block.calculate_hash() != block.hash or not block.meets_difficulty():
+            raise RuntimeError(f'Solução inválida para {estrategia}/{num_workers} workers')
+        nonce = block.nonce
+
+    return {
+        'strategy': estrategia,
+        'workers': num_workers,
+        'difficulty_bits': difficulty_bits,
+        'repeat': repeticao,
+        'nonce': nonce,
+        'hashes': estatisticas['tentativas'],
+        'seconds': round(segundos, 6),
+        'hashes_per_second': round(estatisticas['tentativas'] / segundos, 1) if segundos else None
+    }
+
+
+def resumir(execucoes, inicializacoes):
+    """Agrupa as repetições por configuração com média e desvio padrão.
+
+    `inicializacoes` mapeia (estratégia, workers) ao tempo de criação do pool.
+    """
+    grupos = {}
+    for execucao in execucoes:
+        chave = (execucao['strategy'], execucao['workers'], execucao['difficulty_bits'])
+        grupos.setdefault(chave, []).append(execucao)
+
+    resumo = []
+    for (estrategia, num_workers, difficulty_bits), grupo in grupos.items():
+        segundos = [e['seconds'] for e in grupo]
+        taxas = [e['hashes_per_second'] for e in grupo if e['hashes_per_second'] is not None]
+        resumo.append({
+            'strategy': estrategia,
+            'workers': num_workers,
+            'difficulty_bits': difficulty_bits,
+            'runs': len(grupo),
+            'startup_seconds': inicializacoes.get((estrategia, num_workers)),
+            'seconds_mean': round(statistics.mean(segundos), 6),
+            'seconds_stdev': round(statistics.stdev(segundos), 6) if len(segundos) > 1 else 0.0,
+            'seconds_min': min(segundos),
+            'seconds_max': max(segundos),
+            'hashes_per_second_mean': round(statistics.mean(taxas), 1) if taxas else None,
+            'hashes_per_second_stdev': round(statistics.stdev(taxas), 1) if len(taxas) > 1 else 0.0
+        })
+    return resumo
+
+
+def executar_benchmark(dificuldades, workers, estrategias, repeticoes):
+    """Executa todas as combinações e retorna (execucoes, resumo)"""
+    execucoes = []
+    inicializacoes = {}
+    for estrategia in estrategias:
+        # A estratégia serial usa sempre uma única thread
+        lista_workers = [1] if estrategia == 'serial' else workers
+        for num_workers in lista_workers:
+            # A criação dos workers fica fora das medições
+            pool, inicializacao = iniciar_pool(estrategia, num_workers)
+            inicializacoes[(estrategia, num_workers)] = inicializacao
+            print(f"{estrategia:>9} | {num_workers:>3} workers | inicialização do pool: {inicializacao:.3f} s")
+            with pool:
+                for difficulty_bits in dificuldades:
+                    for repeticao in range(repeticoes):
+                        execucao = medir(pool, estrategia, num_workers, difficulty_bits, repeticao)
+                        print(f"{estrategia:>9} | {num_workers:>3} workers | {difficulty_bits:>2} bits | "
+                              f"#{repeticao} | {execucao['seconds']:.3f} s | {execucao['hashes_per_second']} H/s")
+                        execucoes.append(execucao)
+    return execucoes, resumir(execucoes, inicializacoes)
+
+
+def salvar_resultados(caminho, execucoes, resumo, parametros):
+    """Salva em JSON (completo) ou CSV (resumo + arquivo *_runs.csv com as execuções)"""
+    if caminho.endswith('.csv'):
+        with open(caminho, 'w', newline='') as arquivo:
+            writer = csv.DictWriter(arquivo, fieldnames=CAMPOS_RESUMO)
+            writer.writeheader()
+            writer.writerows(resumo)
+        with open(caminho[:-len('.csv')] + '_runs.csv', 'w', newline='') as arquivo:
+            writer = csv.DictWriter(arquivo, fieldnames=CAMPOS_EXECUCAO)
+            writer.writeheader()
+            writer.writerows(execucoes)
+    else:
+        with open(caminho, 'w') as arquivo:
+            json.dump({'parameters': parametros, 'summary': resumo, 'runs': execucoes}, arquivo, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark da mineração de blocos')
+    parser.add_argument('--difficulties', type=int, nargs='+', default=[16, 20],
+                        help='dificuldades em bits zero iniciais')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1],
+                        help='quantidades de workers para threads/processos')
+    parser.add_argument('--strategies', nargs='+', default=list(mining.ESTRATEGIAS),
+                        choices=mining.ESTRATEGIAS)
+    parser.add_argument('--repeats', type=int, default=3, help='repetições por configuração')
+    parser.add_argument('--output', default='benchmark_mining.json',
+                        help='arquivo de saída (.json ou .csv)')
+    args = parser.parse_args()
+
+    parametros = {
+        'difficulties': args.difficulties,
+        'workers': args.workers,
+        'strategies': args.strategies,
+        'repeats': args.repeats,
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    execucoes, resumo = executar_benchmark(args.difficulties, args.workers, args.strategies, args.repeats)
+    salvar_resultados(args.output, execucoes, resumo, parametros)
+    print(f"Resultados salvos em {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# Importação em lote de estabelecimentos a partir de CSV ou NDJSON.
+#
+# Cada registro precisa de nome, latitude e longitude (cabeçalho do CSV ou
+# chaves do objeto JSON). O arquivo é lido em fluxo e processado em lotes:
+# o nome único e a distância mínima de 2km são conferidos dentro do lote e
+# contra a coleção (pelo índice espacial em memória, confirmando no MongoDB
+# o que o índice não conhece, para enxergar cadastros de outros processos),
+# os registros aceitos são gravados com um único insert_many e cada lote vira
+# um único bloco na blockchain. O relatório traz um resultado por linha do
+# arquivo.
+#
+# Exemplos:
+#   python app/bulk_import.py estabelecimentos.csv
+#   python app/bulk_import.py estabelecimentos.ndjson --batch-size 500 --report relatorio.ndjson
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import math
+import os
+import queue
+
+from pymongo.errors import BulkWriteError
+
+from spatial_index import SpatialIndex, DISTANCIA_MINIMA_KM
+
+# Registros por lote (um insert_many e um bloco por lote)
+TAMANHO_LOTE_IMPORTACAO = 1000
+
+
+def detectar_formato(nome_arquivo=None, tipo_conteudo=None):
+    """'ndjson' pela extensão ou pelo Content-Type; senão 'csv'"""
+    nome_arquivo = (nome_arquivo or '').lower()
+    tipo_conteudo = (tipo_conteudo or '').lower()
+    if nome_arquivo.endswith(('.ndjson', '.jsonl')) or 'ndjson' in tipo_conteudo or 'jsonl' in tipo_conteudo:
+        return 'ndjson'
+    return 'csv'
+
+
+def ler_linhas(linhas, formato):
+    """Gera (número da linha, dados, erro) para cada registro de um iterável de linhas de texto"""
+    if formato == 'ndjson':
+        for numero, texto in enumerate(linhas, 1):
+            if not texto.strip():
+                continue
+            try:
+                dados = json.loads(texto)
+            except ValueError as e:
+                yield numero, None, f'JSON inválido: {str(e)}'
+                continue
+            if not isinstance(dados, dict):
+                yield numero, None, 'A linha deve ser um objeto JSON'
+                continue
+            yield numero, dados, None
+    elif formato == 'csv':
+        leitor = csv.DictReader(linhas)
+        for dados in leitor:
+            # line_num é a linha do arquivo (o cabeçalho é a linha 1)
+            yield leitor.line_num, dados, None
+    else:
+        raise ValueError(f'Formato desconhecido: {formato}')
+
+
+def validar_dados(dados):
+    """Retorna (nome, latitude, longitude) do registro ou lança ValueError"""
+    nome = str(dados.get('nome') or '').strip()
+    if not nome:
+        raise ValueError('Nome ausente')
+    try:
+        latitude = float(dados.get('latitude'))
+        longitude = float(dados.get('longitude'))
+    except (TypeError, ValueError):
+        raise ValueError('Latitude e longitude devem ser números')
+    if not (math.isfinite(latitude) and math.isfinite(longitude)
+            and -90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Coordenadas fora do intervalo válido')
+    return nome, latitude, longitude
+
+
+def importar_estabelecimentos(registros, colecao, indice_espacial, blockchain,
+                              tamanho_lote=TAMANHO_LOTE_IMPORTACAO, distancia_minima_km=DISTANCIA_MINIMA_KM):
+    """Importa os registros gerados por ler_linhas, um lote por vez.
+
+    Gera um resultado por registro, na ordem do arquivo: dict com linha, nome,
+    status ('aceito' ou 'rejeitado') e establishment_id ou motivo.
+    """
+    lote = []
+    for registro in registros:
+        lote.append(registro)
+        if len(lote) >= tamanho_lote:
+            yield from _importar_lote(lote, colecao, indice_espacial, blockchain, distancia_minima_km)
+            lote = []
+    if lote:
+        yield from _importar_lote(lote, colecao, indice_espacial, blockchain, distancia_minima_km)
+
+
+def _importar_lote(lote, colecao, indice_espacial, blockchain, distancia_minima_km):
+    resultados = []
+    aceitos = []
+    # Registros já aceitos neste lote, ainda fora da coleção e do índice
+    pendentes = SpatialIndex(None, distancia_minima_km)
+
+    for numero, dados, erro in lote:
+        resultado = {'linha': numero, 'nome': (dados or {}).get('nome'), 'status': 'rejeitado'}
+        resultados.append(resultado)
+        if erro is None:
+            try:
+                nome, latitude, longitude = validar_dados(dados)
+            except ValueError as e:
+                erro = str(e)
+        if erro is None:
+            resultado['nome'] = nome
+            if pendentes.contains_name(nome) or indice_espacial.name_taken(nome):
+                erro = 'Um estabelecimento com este nome já existe!'
+            elif (pendentes.any_within(latitude, longitude, distancia_minima_km)
+                    or indice_espacial.occupied_within(latitude, longitude, distancia_minima_km)):
+                erro = f'Existe um estabelecimento a menos de {distancia_minima_km}km de distância.'
+        if erro is not None:
+            resultado['motivo'] = erro
+            continue
+
+        pendentes.add(numero, nome, latitude, longitude)
+        aceitos.append((resultado, {
+            'nome': nome,
+            'latitude': latitude,
+            'longitude': longitude,
+            'localizacao': {'type': 'Point', 'coordinates': [longitude, latitude]}
+        }))
+
+    if aceitos:
+        documentos = [documento for _, documento in aceitos]
+        erro_gravacao = None
+        try:
+            # insert_many preenche o _id de cada documento
+            colecao.insert_many(documentos, ordered=True)
+            gravados = len(documentos)
+        except BulkWriteError as e:
+            # Em modo ordenado, só os documentos antes do primeiro erro foram gravados
+            gravados = e.details.get('nInserted', 0)
+            erro_gravacao = f"Erro ao gravar: {e.details['writeErrors'][0].get('errmsg')}"
+
+        timestamp = str(datetime.datetime.now())
+        establishments = []
+        for posicao, (resultado, documento) in enumerate(aceitos):
+            if posicao >= gravados:
+                resultado['motivo'] = erro_gravacao
+                continue
+            establishment_id = str(documento['_id'])
+            resultado['status'] = 'aceito'
+            resultado['establishment_id'] = establishment_id
+            indice_espacial.add(establishment_id, documento['nome'], documento['latitude'], documento['longitude'])
+            establishments.append({
+                'establishment_id': establishment_id,
+                'nome': documento['nome'],
+                'latitude': documento['latitude'],
+                'longitude': documento['longitude'],
+                'timestamp': timestamp
+            })
+        # O lote inteiro é minerado em um único bloco
+        if establishments:
+            try:
+                blockchain.add_establishments_batch_async(establishments)
+            except queue.Full:
+                # Sem vaga na fila de mineração: o lote gravado é desfeito e rejeitado
+                gravados_ids = [documento['_id'] for _, documento in aceitos[:gravados]]
+                colecao.delete_many({'_id': {'$in': gravados_ids}})
+                for resultado, documento in aceitos[:gravados]:
+                    indice_espacial.remove(documento['_id'])
+                    resultado['status'] = 'rejeitado'
+                    resultado['motivo'] = 'Fila de mineração cheia'
+                    del resultado['establishment_id']
+
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Importação em lote de estabelecimentos')
+    parser.add_argument('arquivo', help='arquivo CSV ou NDJSON com nome, latitude e longitude')
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help='padrão: pela extensão do arquivo')
+    parser.add_argument('--batch-size', type=int, default=int(os.getenv('BULK_IMPORT_BATCH_SIZE', TAMANHO_LOTE_IMPORTACAO)))
+    parser.add_argument('--report', help='grava o resultado de cada linha neste arquivo NDJSON')
+    args = parser.parse_args()
+
+    import mining
+    from establishment_blockchain import connect_database, get_blockchain
+
+    colecao = connect_database()['estabelecimentos']
+    indice_espacial = SpatialIndex(colecao)
+    indice_espacial.load()
+    blockchain = get_blockchain()
+
+    formato = args.format or detectar_formato(args.arquivo)
+    contagem = {'aceito': 0, 'rejeitado': 0}
+    with open(args.arquivo, encoding='utf-8-sig', newline='') as arquivo, \
+            (open(args.report, 'w', encoding='utf-8') if args.report else contextlib.nullcontext()) as relatorio:
+        registros = ler_linhas(arquivo, formato)
+        for resultado in importar_estabelecimentos(registros, colecao, indice_espacial, blockchain, args.batch_size):
+            contagem[resultado['status']] += 1
+            if relatorio is not None:
+                relatorio.write(json.dumps(resultado, ensure_ascii=False) + '\n')
+            elif resultado['status'] == 'rejeitado':
+                print(f"Linha {resultado['linha']}: {resultado['motivo']}")
+
+    print(f"{contagem['aceito']} estabelecimentos importados, {contagem['rejeitado']} rejeitados")
+    print("Aguardando a mineração dos blocos...")
+    mining.shutdown_mining_service()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+from pymongo import UpdateOne, InsertOne, DeleteMany
+
+# Operações enviadas por chamada a bulk_write
+TAMANHO_LOTE_PADRAO = 1000
+
+
+def imprimir_progresso(enviadas, total):
+    """Relatório de progresso padrão: uma linha por lote enviado"""
+    if total:
+        print(f"Gravação em lote: {enviadas}/{total} operações ({100 * enviadas // total}%)")
+    else:
+        print(f"Gravação em lote: {enviadas} operações")
+
+
+class BulkWriter:
+    """Acumula operações de escrita e as envia ao MongoDB com bulk_write.
+
+    Cada lote de `batch_size` operações é uma única ida ao banco. Com
+    `ordered=False` (padrão) o servidor pode aplicar as operações em
+    qualquer ordem e continua após um erro; use apenas quando as operações
+    forem independentes (ex.: cada uma altera um bloco diferente).
+    `progresso(enviadas, total)` é chamado após cada lote.
+
+    Pode ser usado como gerenciador de contexto; o restante é enviado na saída.
+    """
+
+    def __init__(self, collection, batch_size=TAMANHO_LOTE_PADRAO, ordered=False, progresso=None, total=None):
+        self.collection = collection
+        self.batch_size = max(1, batch_size)
+        self.ordered = ordered
+        self.progresso = progresso
+        self.total = total
+        self._operacoes = []
+        self.enviadas = 0
+        self.resultado = {'inserted': 0, 'matched': 0, 'modified': 0, 'deleted': 0, 'upserted': 0}
+
+    def add(self, operacao):
+        """Adiciona uma operação do pymongo (UpdateOne, InsertOne, ...)"""
+        self._operacoes.append(operacao)
+        if len(self._operacoes) >= self.batch_size:
+            self.flush()
+
+    def update_one(self, filtro, update, upsert=False):
+        self.add(UpdateOne(filtro, update, upsert=upsert))
+
+    def insert_one(self, documento):
+        self.add(InsertOne(documento))
+
+    def delete_many(self, filtro):
+        self.add(DeleteMany(filtro))
+
+    def flush(self):
+        """Envia as operações acumuladas em uma única chamada"""
+        if not self._operacoes:
+            return
+        operacoes, self._operacoes = self._operacoes, []
+        resultado = self.collection.bulk_write(operacoes, ordered=self.ordered)
+        self.resultado['inserted'] += resultado.inserted_count
+        self.resultado['matched'] += resultado.matched_count
+        self.resultado['modified'] += resultado.modified_count
+        self.resultado['deleted'] += resultado.deleted_count
+        self.resultado['upserted'] += resultado.upserted_count
+        self.enviadas += len(operacoes)
+        if self.progresso is not None:
+            self.progresso(self.enviadas, self.total)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traceback):
+        # Em caso de exceção, descartar o lote incompleto
+        if tipo is None:
+            self.flush()
+        return False
@@ -0,0 +1,276 @@
+import datetime
+import threading
+from array import array
+from collections import OrderedDict
+
+# Referência para gravar timestamps como microssegundos em um inteiro de 64 bits
+_EPOCA = datetime.datetime(1970, 1, 1)
+_MICROSSEGUNDO = datetime.timedelta(microseconds=1)
+
+# Quantidade de blocos cujos dados são buscados por consulta ao percorrer a chain
+TAMANHO_LOTE_LEITURA = 500
+
+
+def codificar_hash(valor):
+    """Converte um hash hexadecimal de 64 caracteres em 32 bytes, ou None"""
+    if not isinstance(valor, str) or len(valor) != 64:
+        return None
+    try:
+        digest = bytes.fromhex(valor)
+    except ValueError:
+        return None
+    # Só aceitar a forma que volta idêntica (hex minúsculo)
+    return digest if digest.hex() == valor else None
+
+
+def codificar_timestamp(valor):
+    """Converte o timestamp (str(datetime)) em microssegundos, ou None"""
+    if not isinstance(valor, str):
+        return None
+    try:
+        momento = datetime.datetime.fromisoformat(valor)
+    except ValueError:
+        return None
+    if momento.tzinfo is not None:
+        return None
+    micros = (momento - _EPOCA) // _MICROSSEGUNDO
+    # O cabeçalho usa o texto original: só compactar se ele for reconstruído igual
+    return micros if decodificar_timestamp(micros) == valor else None
+
+
+def decodificar_timestamp(micros):
+    return str(_EPOCA + micros * _MICROSSEGUNDO)
+
+
+class CompactChain:
+    """Chain em memória guardada em colunas em vez de objetos Block.
+
+    Hashes ficam como 32 bytes brutos em um bytearray, e nonces, timestamps,
+    índices, dificuldades e versões em arrays de inteiros. Os dados dos
+    estabelecimentos não ficam em memória: são lidos do MongoDB quando um
+    bloco é acessado, passando por um cache LRU limitado; os dados do último
+    bloco ficam fixos fora do LRU, porque a ponta da chain é lida a cada novo
+    bloco e nunca deve custar uma consulta. Valores fora do
+    formato esperado (ex.: o previous_hash "0" do genesis) ficam em um dict
+    à parte, para que o bloco reconstruído seja idêntico ao original.
+
+    Suporta as operações de lista usadas pela blockchain: len, índice
+    (inclusive negativo), fatias, iteração, append e atribuição por posição.
+    """
+
+    def __init__(self, collection, block_factory, cache_size=1000):
+        self.collection = collection
+        # Recebe um documento do MongoDB e devolve um Block
+        self.block_factory = block_factory
+        self.cache_size = cache_size
+        self._indices = array('q')
+        self._timestamps = array('q')
+        self._nonces = array('q')
+        self._dificuldades = array('B')
+        self._versoes = array('B')
+        self._hashes = bytearray()
+        self._hashes_anteriores = bytearray()
+        # posição -> {campo: valor original} para valores que não cabem nas colunas
+        self._irregulares = {}
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # (índice, dados) do último bloco, ou None se ainda não foram lidos
+        self._ponta = None
+
+    def __len__(self):
+        return len(self._indices)
+
+    def _posicao(self, posicao):
+        if posicao < 0:
+            posicao += len(self)
+        if not 0 <= posicao < len(self):
+            raise IndexError('posição fora da chain')
+        return posicao
+
+    def _gravar_colunas(self, posicao, block):
+        """Grava os campos do cabeçalho do bloco na posição informada"""
+        irregulares = {}
+
+        digest = codificar_hash(block.hash)
+        if digest is None:
+            irregulares['hash'] = block.hash
+            digest = bytes(32)
+        anterior = codificar_hash(block.previous_hash)
+        if anterior is None:
+            irregulares['previous_hash'] = block.previous_hash
+            anterior = bytes(32)
+        micros = codificar_timestamp(block.timestamp)
+        if micros is None:
+            irregulares['timestamp'] = block.timestamp
+            micros = 0
+        nonce = block.nonce
+        if type(nonce) is not int or not -2 ** 63 <= nonce < 2 ** 63:
+            irregulares['nonce'] = nonce
+            nonce = 0
+        bits = block.difficulty_bits
+        if type(bits) is not int or not 0 <= bits < 256:
+            irregulares['difficulty_bits'] = bits
+            bits = 0
+        versao = block.version
+        if type(versao) is not int or not 0 <= versao < 256:
+            irregulares['version'] = versao
+            versao = 0
+
+        if posicao == len(self):
+            self._indices.append(block.index)
+            self._timestamps.append(micros)
+            self._nonces.append(nonce)
+            self._dificuldades.append(bits)
+            self._versoes.append(versao)
+            self._hashes += digest
+            self._hashes_anteriores += anterior
+        else:
+            self._indices[posicao] = block.index
+            self._timestamps[posicao] = micros
+            self._nonces[posicao] = nonce
+            self._dificuldades[posicao] = bits
+            self._versoes[posicao] = versao
+            self._hashes[posicao * 32:(posicao + 1) * 32] = digest
+            self._hashes_anteriores[posicao * 32:(posicao + 1) * 32] = anterior
+
+        if irregulares:
+            self._irregulares[posicao] = irregulares
+        else:
+            self._irregulares.pop(posicao, None)
+
+    def append(self, block):
+        """Adiciona o bloco ao fim da chain; os dados ficam só no cache"""
+        self._gravar_colunas(len(self), block)
+        # Blocos só com cabeçalho (modo leve) não têm dados para guardar
+        if block.data_loaded():
+            self._guardar_no_cache(block.index, block.establishment_data)
+        self._fixar_ponta(len(self) - 1, block)
+
+    def __setitem__(self, posicao, block):
+        posicao = self._posicao(posicao)
+        self._gravar_colunas(posicao, block)
+        if block.data_loaded():
+            self._guardar_no_cache(block.index, block.establishment_data)
+        self._fixar_ponta(posicao, block)
+
+    def _fixar_ponta(self, posicao, block):
+        """Guarda os dados do bloco se ele for o último (sem dados, a ponta é lida na próxima vez)"""
+        if posicao == len(self) - 1:
+            self._ponta = (block.index, block.establishment_data) if block.data_loaded() else None
+
+    def hash_at(self, posicao):
+        """Hash (hex) do bloco na posição, sem carregar os dados do estabelecimento"""
+        posicao = self._posicao(posicao)
+        irregulares = self._irregulares.get(posicao)
+        if irregulares and 'hash' in irregulares:
+            return irregulares['hash']
+        return self._hashes[posicao * 32:(posicao + 1) * 32].hex()
+
+    def index_at(self, posicao):
+        """Índice do bloco na posição, sem carregar os dados do estabelecimento"""
+        return self._indices[self._posicao(posicao)]
+
+    def _documento(self, posicao, establishment_data):
+        """Monta o documento do bloco a partir das colunas"""
+        documento = {
+            'index': self._indices[posicao],
+            'timestamp': decodificar_timestamp(self._timestamps[posicao]),
+            'establishment_data': establishment_data,
+            'previous_hash': self._hashes_anteriores[posicao * 32:(posicao + 1) * 32].hex(),
+            'nonce': self._nonces[posicao],
+            'hash': self._hashes[posicao * 32:(posicao + 1) * 32].hex(),
+            'difficulty_bits': self._dificuldades[posicao],
+            'version': self._versoes[posicao]
+        }
+        documento.update(self._irregulares.get(posicao, {}))
+        return documento
+
+    def _guardar_no_cache(self, index, establishment_data):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[index] = establishment_data
+            self._cache.move_to_end(index)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _dados_do_cache(self, index):
+        with self._cache_lock:
+            if index not in self._cache:
+                return False, None
+            self._cache.move_to_end(index)
+            return True, self._cache[index]
+
+    def _carregar_dados(self, index):
+        """Busca os dados do estabelecimento na ponta, no cache ou no MongoDB"""
+        ponta = self._ponta
+        if ponta is not None and ponta[0] == index:
+            return ponta[1]
+        encontrado, establishment_data = self._dados_do_cache(index)
+        if encontrado:
+            return establishment_data
+        documento = self.collection.find_one(
+            {'index': index, 'hash': {'$exists': True}},
+            {'establishment_data': 1}
+        )
+        establishment_data = documento.get('establishment_data') if documento else None
+        self._guardar_no_cache(index, establishment_data)
+        if len(self) and index == self._indices[-1]:
+            self._ponta = (index, establishment_data)
+        return establishment_data
+
+    def _carregar_lote(self, inicio, fim):
+        """Reconstrói os blocos de [inicio, fim) com uma única consulta ao banco"""
+        indices = self._indices[inicio:fim]
+        if not indices:
+            return []
+        dados = {}
+        faltando = []
+        ponta = self._ponta
+        if ponta is not None:
+            dados[ponta[0]] = ponta[1]
+        for index in indices:
+            if index in dados:
+                continue
+            encontrado, establishment_data = self._dados_do_cache(index)
+            if encontrado:
+                dados[index] = establishment_data
+            else:
+                faltando.append(index)
+        if faltando:
+            documentos = self.collection.find(
+                {'index': {'$gte': min(faltando), '$lte': max(faltando)}, 'hash': {'$exists': True}},
+                {'index': 1, 'establishment_data': 1}
+            )
+            for documento in documentos:
+                dados.setdefault(documento['index'], documento.get('establishment_data'))
+        # Leituras em sequência não passam pelo cache para não expulsar os blocos mais usados
+        return [self.block_factory(self._documento(inicio + i, dados.get(index)))
+                for i, index in enumerate(indices)]
+
+    def __getitem__(self, posicao):
+        if isinstance(posicao, slice):
+            inicio, fim, passo = posicao.indices(len(self))
+            if passo != 1:
+                return [self[i] for i in range(inicio, fim, passo)]
+            blocks = []
+            for lote_inicio in range(inicio, fim, TAMANHO_LOTE_LEITURA):
+                blocks.extend(self._carregar_lote(lote_inicio, min(lote_inicio + TAMANHO_LOTE_LEITURA, fim)))
+            return blocks
+        posicao = self._posicao(posicao)
+        establishment_data = self._carregar_dados(self._indices[posicao])
+        return self.block_factory(self._documento(posicao, establishment_data))
+
+    def __iter__(self):
+        # O tamanho é lido a cada lote: blocos adicionados durante a iteração também aparecem
+        inicio = 0
+        while inicio < len(self):
+            fim = min(inicio + TAMANHO_LOTE_LEITURA, len(self))
+            yield from self._carregar_lote(inicio, fim)
+            inicio = fim
+
+    def memory_usage(self):
+        """Bytes ocupados pelas colunas (sem o cache e os valores irregulares)"""
+        colunas = (self._indices, self._timestamps, self._nonces, self._dificuldades, self._versoes)
+        return sum(coluna.itemsize * len(coluna) for coluna in colunas) + \
+            len(self._hashes) + len(self._hashes_anteriores)
@@ -1,137 +1,854 @@
+import collections
 import hashlib
-import time
 import datetime
+import itertools
 import json
+import math
 import os
+import queue
 import threading
+from concurrent.futures import ProcessPoolExecutor
 from pymongo import MongoClient
 from pymongo.server_api import ServerApi
+from bson import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
+import mining
+import merkle
+from bulk_writer import BulkWriter, imprimir_progresso
+from chain_store import CompactChain
+import snapshot
+
+# Dificuldade fixa usada antes do ajuste automático: 6 zeros hexadecimais
+DIFICULDADE_LEGADA_BITS = 24
+# Variação máxima de dificuldade (em bits) a cada novo bloco
+AJUSTE_MAXIMO_BITS = 2
+# Blocos por trecho na auditoria (máximo por trecho na auditoria paralela)
+TAMANHO_TRECHO_AUDITORIA = 500
+
+# Versões da serialização do cabeçalho usada no hash do bloco:
+# 1 = concatenação de str() dos campos (repr do dict, blocos antigos)
+# 2 = JSON canônico com o digest dos dados, usada nos blocos novos
+VERSAO_LEGADA = 1
+VERSAO_ATUAL = 2
+# Campos lidos no modo leve: o cabeçalho, o digest dos dados e apenas os ids
+# dos estabelecimentos (para os índices em memória)
+PROJECAO_CABECALHO = {
+    'index': 1, 'timestamp': 1, 'previous_hash': 1, 'nonce': 1, 'hash': 1,
+    'difficulty_bits': 1, 'version': 1, 'payload_digest': 1,
+    'establishment_data.establishment_id': 1,
+    'establishment_data.establishments.establishment_id': 1
+}
+# Campos que invalidam o cabeçalho em cache quando alterados
+CAMPOS_CABECALHO = frozenset(['index', 'timestamp', 'establishment_data', 'previous_hash',
+                              'difficulty_bits', 'version'])
+
+def required_difficulty_bits(version, min_difficulty_bits):
+    """Dificuldade mínima que um bloco da versão informada precisa ter registrado.
+
+    O cabeçalho da versão 1 não inclui a dificuldade, então o valor gravado
+    pode ser alterado sem mudar o hash: esses blocos precisam atingir o
+    alvo fixo. A partir da versão 2 a dificuldade faz parte do hash.
+    """
+    if version == VERSAO_LEGADA:
+        return max(min_difficulty_bits, DIFICULDADE_LEGADA_BITS)
+    return min_difficulty_bits
+
 
 class Block:
-    def __init__(self, index, timestamp, establishment_data, previous_hash):
+    # Sem __dict__ por instância: a chain pode ter milhões de blocos em memória
+    __slots__ = ('index', 'timestamp', '_establishment_data', 'previous_hash', 'nonce', 'difficulty_bits',
+                 '_hash', 'version', '_header', '_merkle_root', '_payload_digest', '_carregar_dados')
+
+    def __init__(self, index, timestamp, establishment_data, previous_hash, version=VERSAO_ATUAL):
         self.index = index
         self.timestamp = timestamp
         self.establishment_data = establishment_data
         self.previous_hash = previous_hash
         self.nonce = 0
-        self.hash = self.calculate_hash()
+        self.difficulty_bits = DIFICULDADE_LEGADA_BITS
+        self.version = version
+        # O hash só é calculado quando lido: os blocos lidos do banco recebem
+        # o hash gravado e os novos recebem o da mineração
+        self._hash = None
+
+    @property
+    def hash(self):
+        """Hash do bloco; calculado no primeiro acesso se nenhum foi atribuído"""
+        if self._hash is None:
+            self._hash = self.calculate_hash()
+        return self._hash
+
+    @hash.setter
+    def hash(self, valor):
+        self._hash = valor
+
+    def __setattr__(self, nome, valor):
+        object.__setattr__(self, nome, valor)
+        if nome in CAMPOS_CABECALHO:
+            # O cabeçalho serializado é calculado uma vez e reaproveitado até uma alteração
+            object.__setattr__(self, '_header', None)
+
+    @property
+    def establishment_data(self):
+        """Dados do bloco; em blocos só com cabeçalho, buscados no primeiro acesso"""
+        if self._carregar_dados is not None:
+            self.load_data(self._carregar_dados())
+        return self._establishment_data
+
+    @establishment_data.setter
+    def establishment_data(self, valor):
+        object.__setattr__(self, '_establishment_data', valor)
+        object.__setattr__(self, '_carregar_dados', None)
+        object.__setattr__(self, '_payload_digest', None)
+        object.__setattr__(self, '_merkle_root', None)
+
+    def load_data(self, establishment_data):
+        """Preenche os dados de um bloco só com cabeçalho, mantendo o digest do cabeçalho"""
+        object.__setattr__(self, '_establishment_data', establishment_data)
+        object.__setattr__(self, '_carregar_dados', None)
+
+    def data_loaded(self):
+        """Indica se os dados do bloco já estão em memória"""
+        return self._carregar_dados is None
+
+    def header_needs_data(self):
+        """Indica se calcular o hash exige buscar os dados do bloco"""
+        if self.data_loaded() or self._header is not None:
+            return False
+        return self.version == VERSAO_LEGADA or self._payload_digest is None
+
+    def is_batch(self):
+        """Indica se o bloco agrupa vários estabelecimentos (modo em lote)"""
+        return isinstance(self.establishment_data, dict) and 'establishments' in self.establishment_data
+
+    @property
+    def merkle_root(self):
+        """Raiz de Merkle dos registros de um bloco em lote (None nos demais)"""
+        if not self.is_batch():
+            return None
+        if self._merkle_root is None:
+            self._merkle_root = merkle.merkle_root(self.establishment_data['establishments'])
+        return self._merkle_root
+
+    def payload_str(self):
+        """Representação dos dados do bloco usada no cabeçalho da versão 1"""
+        if self.is_batch():
+            # Blocos em lote comprometem os registros pela raiz de Merkle
+            return self.merkle_root
+        return str(self.establishment_data)
+
+    def payload_digest(self):
+        """Digest (hex) dos dados do bloco usado no cabeçalho da versão 2"""
+        if self._payload_digest is None:
+            self._payload_digest = self._calcular_payload_digest()
+        return self._payload_digest
+
+    def _calcular_payload_digest(self):
+        if self.is_batch():
+            return self.merkle_root
+        return merkle.hash_registro(self.establishment_data).hex()
+
+    def header_bytes(self):
+        """Serializa a parte fixa do bloco (tudo menos o nonce), com cache"""
+        if self._header is None:
+            if self.version == VERSAO_LEGADA:
+                # Compatibilidade: blocos antigos foram minerados sobre o repr dos dados
+                header = (str(self.index) + str(self.timestamp) + self.payload_str() +
+                          str(self.previous_hash)).encode('utf-8')
+            else:
+                header = merkle.serializar({
+                    'version': self.version,
+                    'index': self.index,
+                    'timestamp': self.timestamp,
+                    'previous_hash': self.previous_hash,
+                    'difficulty_bits': self.difficulty_bits,
+                    'payload': self.payload_digest()
+                })
+            self._header = header
+        return self._header
+
+    def hash_base(self):
+        """Retorna um SHA-256 já alimentado com a parte fixa do bloco"""
+        return hashlib.sha256(self.header_bytes())
 
     def calculate_hash(self):
         """Calcula o hash SHA256 do bloco usando a mesma lógica do blockchain.py"""
-        data = str(self.index) + str(self.timestamp) + str(self.establishment_data) + str(self.previous_hash) + str(self.nonce)
-        sha256_hash = hashlib.sha256()
-        sha256_hash.update(data.encode('utf-8'))
+        sha256_hash = self.hash_base()
+        sha256_hash.update(str(self.nonce).encode('utf-8'))
         return sha256_hash.hexdigest()
 
-    def mine_block(self, difficulty):
-        """Minera o bloco usando múltiplas threads como no mult_threads.py"""
-        num_threads = os.cpu_count()  # Obtém número de CPUs disponíveis
-        intervalo = 120000000 // num_threads
-        threads = []
-        resultado = []
-        self.solucao_encontrada = False  # Variável de controle para todas as threads
-
-        def calcular_hash_intervalo(inicio, fim, target):
-            """Função que cada thread executará para encontrar o hash"""
-            for i in range(inicio, fim):
-                if self.solucao_encontrada:
-                    return
-                
-                self.nonce = i
-                current_hash = self.calculate_hash()
-                if current_hash[:difficulty] == target:
-                    resultado.append((i, current_hash))
-                    self.solucao_encontrada = True
-                    return
-
-        # Criar e iniciar as threads
-        target = "0" * difficulty
-        for i in range(num_threads):
-            inicio = i * intervalo
-            fim = (i + 1) * intervalo
-            thread = threading.Thread(
-                target=calcular_hash_intervalo,
-                args=(inicio, fim, target)
-            )
-            threads.append(thread)
-            thread.start()
-
-        # Aguardar até que a solução seja encontrada ou todas as threads terminem
-        while not self.solucao_encontrada and any(thread.is_alive() for thread in threads):
-            time.sleep(0.1)
-
-        # Aguardar todas as threads concluírem
-        for thread in threads:
-            thread.join()
+    def mine_block(self, difficulty_bits):
+        """Minera o bloco distribuindo intervalos de nonces entre processos"""
+        self.difficulty_bits = difficulty_bits
+        # Cada worker recebe sua própria cópia da parte fixa e testa o alvo em bits
+        resultado = mining.get_mining_service().minerar(self.header_bytes(), difficulty_bits)
 
         # Atualizar o hash se uma solução foi encontrada
         if resultado:
-            self.nonce = resultado[0][0]
-            self.hash = resultado[0][1]
+            self.nonce, self.hash = resultado
             return True
         return False
 
+    def meets_difficulty(self):
+        """Verifica a prova de trabalho contra a dificuldade registrada no bloco"""
+        try:
+            digest = bytes.fromhex(self.hash)
+        except (TypeError, ValueError):
+            return False
+        return len(digest) == 32 and mining.atende_dificuldade(digest, self.difficulty_bits)
+
+    def required_difficulty_bits(self, min_difficulty_bits):
+        """Dificuldade mínima que o bloco precisa ter registrado para ser válido"""
+        return required_difficulty_bits(self.version, min_difficulty_bits)
+
+    def find_record(self, establishment_id):
+        """Retorna a posição do estabelecimento no bloco, ou None"""
+        if self.is_batch():
+            for posicao, registro in enumerate(self.establishment_data['establishments']):
+                if registro.get('establishment_id') == establishment_id:
+                    return posicao
+        elif isinstance(self.establishment_data, dict) and \
+                self.establishment_data.get('establishment_id') == establishment_id:
+            return 0
+        return None
+
+    def inclusion_proof(self, establishment_id):
+        """Retorna a prova de Merkle do estabelecimento em um bloco em lote"""
+        posicao = self.find_record(establishment_id)
+        if posicao is None or not self.is_batch():
+            return None
+        registros = self.establishment_data['establishments']
+        return {
+            'merkle_root': self.merkle_root,
+            'leaf_count': len(registros),
+            'record': registros[posicao],
+            'position': posicao,
+            'proof': merkle.merkle_proof(registros, posicao)
+        }
+
+    @classmethod
+    def from_document(cls, block_data):
+        """Reconstrói um Block a partir do documento salvo no MongoDB"""
+        block = cls(
+            block_data['index'],
+            block_data['timestamp'],
+            block_data['establishment_data'],
+            block_data['previous_hash'],
+            # Documentos sem versão são anteriores à serialização canônica
+            version=block_data.get('version', VERSAO_LEGADA)
+        )
+        block.nonce = block_data['nonce']
+        block.hash = block_data['hash']
+        block.difficulty_bits = block_data.get('difficulty_bits', DIFICULDADE_LEGADA_BITS)
+        return block
+
+    @classmethod
+    def from_header(cls, block_data, carregar_dados):
+        """Reconstrói um Block só com o cabeçalho (documento lido com PROJECAO_CABECALHO).
+
+        `carregar_dados()` busca os dados quando forem acessados. Nos blocos
+        da versão 2 o hash é conferido com o payload_digest do documento,
+        sem buscar os dados; os da versão 1 precisam deles para o hash.
+        """
+        block = cls(
+            block_data['index'],
+            block_data['timestamp'],
+            None,
+            block_data['previous_hash'],
+            version=block_data.get('version', VERSAO_LEGADA)
+        )
+        block._carregar_dados = carregar_dados
+        # Sem digest no documento (versão 1 ou blocos antigos), ele é calculado dos dados
+        block._payload_digest = block_data.get('payload_digest') if block.version != VERSAO_LEGADA else None
+        block.nonce = block_data['nonce']
+        block.hash = block_data['hash']
+        block.difficulty_bits = block_data.get('difficulty_bits', DIFICULDADE_LEGADA_BITS)
+        return block
+
+    def header_dict(self):
+        """Campos do cabeçalho do bloco, sem ler os dados"""
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'previous_hash': self.previous_hash,
+            'nonce': self.nonce,
+            'hash': self.hash,
+            'difficulty_bits': self.difficulty_bits,
+            'version': self.version
+        }
+
     def to_dict(self):
         # Converte bloco para dict do MongoDB
-        return {
+        block_dict = {
             'index': self.index,
             'timestamp': self.timestamp,
             'establishment_data': self.establishment_data,
             'previous_hash': self.previous_hash,
             'nonce': self.nonce,
-            'hash': self.hash
+            'hash': self.hash,
+            'difficulty_bits': self.difficulty_bits,
+            'version': self.version
         }
+        if self.version != VERSAO_LEGADA:
+            # Permite validar o cabeçalho sem ler os dados (modo leve)
+            block_dict['payload_digest'] = self.payload_digest()
+        if self.is_batch():
+            block_dict['merkle_root'] = self.merkle_root
+        return block_dict
+
+
+def block_validation_errors(current_block, previous_hash, min_difficulty_bits):
+    """Lista os problemas de um bloco em relação ao hash do seu antecessor"""
+    errors = []
+    
+    # Check current hash
+    calculated_hash = current_block.calculate_hash()
+    if current_block.hash != calculated_hash:
+        errors.append(f"Bloco #{current_block.index}: Hash calculado não corresponde ao hash armazenado.")
+        # Add more detail to help understand the tampering
+        errors.append(f"  - Hash armazenado: {current_block.hash[:10]}...")
+        errors.append(f"  - Hash calculado: {calculated_hash[:10]}...")
+    
+    # Check previous hash
+    if current_block.previous_hash != previous_hash:
+        errors.append(f"Bloco #{current_block.index}: Referência ao hash anterior inválida.")
+        # Add more detail
+        errors.append(f"  - Hash anterior armazenado: {current_block.previous_hash[:10]}...")
+        errors.append(f"  - Hash do bloco anterior: {previous_hash[:10]}...")
+    
+    # Check proof of work
+    minimo_bits = current_block.required_difficulty_bits(min_difficulty_bits)
+    if current_block.difficulty_bits < minimo_bits or not current_block.meets_difficulty():
+        errors.append(f"Bloco #{current_block.index}: Prova de trabalho inválida.")
+        # Add more detail
+        errors.append(f"  - Dificuldade registrada: {current_block.difficulty_bits} bits (mínimo {minimo_bits})")
+        errors.append(f"  - Hash: {current_block.hash[:10]}...")
+    
+    # If there was an error, provide info about the block
+    if errors:
+        if current_block.is_batch():
+            errors.append(f"  - Lote com {len(current_block.establishment_data['establishments'])} estabelecimentos")
+        elif isinstance(current_block.establishment_data, dict) and 'nome' in current_block.establishment_data:
+            errors.append(f"  - Nome do estabelecimento: {current_block.establishment_data['nome']}")
+    
+    return errors
+
+
+def _auditar_blocos(blocks, previous_hash, min_difficulty_bits):
+    """Audita uma sequência de blocos; retorna [(índice, erros)] dos blocos adulterados"""
+    problemas = []
+    for block in blocks:
+        block_errors = block_validation_errors(block, previous_hash, min_difficulty_bits)
+        if block_errors:
+            problemas.append((block.index, block_errors))
+        previous_hash = block.hash
+    return problemas
+
+
+def _auditar_documentos(documentos, previous_hash, min_difficulty_bits):
+    """Executado nos workers: audita um trecho da chain recebido como documentos"""
+    blocks = [Block.from_document(documento) for documento in documentos]
+    return _auditar_blocos(blocks, previous_hash, min_difficulty_bits)
+
+
+def iter_audit_blocks(chain, min_difficulty_bits, num_workers=None, total=None, ler_blocos=None):
+    """Audita a chain (a partir do bloco 1) em paralelo, trecho a trecho.
+
+    A chain é dividida em trechos contíguos; cada trecho só precisa do hash
+    do bloco anterior a ele, então os trechos são auditados em processos
+    separados. Os resultados são produzidos na ordem dos blocos, assim que
+    cada trecho termina: (último índice verificado, [(índice, erros)]).
+    `total` limita a auditoria aos primeiros blocos (padrão: a chain inteira).
+    `ler_blocos(inicio, fim)` substitui a fatia chain[inicio:fim] na leitura
+    dos trechos (ex.: para buscar os dados de blocos só com cabeçalho).
+    No máximo 2 × num_workers trechos ficam em andamento: o próximo só é
+    lido e enviado quando o mais antigo termina, então a memória não cresce
+    com a chain.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    if ler_blocos is None:
+        ler_blocos = lambda inicio, fim: chain[inicio:fim]
+    total = len(chain) if total is None else total
+    # Vários trechos por worker equilibram a carga entre os processos
+    tamanho_trecho = max(1, min(TAMANHO_TRECHO_AUDITORIA, -(-(total - 1) // (num_workers * 4))))
+    
+    # Trechos em andamento ao mesmo tempo: limita a memória ocupada pelos documentos
+    max_pendentes = 2 * num_workers
+    
+    # forkserver: um fork deste processo copiaria locks das threads do Flask e do MongoClient
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=mining.contexto_processos()) as pool:
+        pendentes = collections.deque()
+        for inicio in range(1, total, tamanho_trecho):
+            if len(pendentes) >= max_pendentes:
+                # Só lê o próximo trecho depois que o mais antigo termina
+                ultimo, future = pendentes.popleft()
+                yield ultimo, future.result()
+            fim = min(inicio + tamanho_trecho, total)
+            blocks = ler_blocos(inicio - 1, fim)
+            previous_hash = blocks[0].hash
+            # Só cabeçalho e dados: o digest e a raiz de Merkle são recalculados nos workers
+            documentos = [dict(block.header_dict(), establishment_data=block.establishment_data)
+                          for block in blocks[1:]]
+            pendentes.append((fim - 1, pool.submit(_auditar_documentos, documentos, previous_hash,
+                                                   min_difficulty_bits)))
+        while pendentes:
+            ultimo, future = pendentes.popleft()
+            yield ultimo, future.result()
+
+
+def audit_blocks(chain, min_difficulty_bits, num_workers=None, total=None):
+    """Audita a chain inteira em paralelo; retorna (erros, conjunto de índices adulterados)"""
+    errors = []
+    tampered_blocks = set()
+    for _, problemas in iter_audit_blocks(chain, min_difficulty_bits, num_workers, total):
+        for index, block_errors in problemas:
+            errors.extend(block_errors)
+            tampered_blocks.add(index)
+    return errors, tampered_blocks
+
+
+class EstablishmentBatcher:
+    """Agrupa cadastros pendentes para minerar vários estabelecimentos em um só bloco.
+
+    O lote é enviado ao serviço de mineração quando atinge `batch_size`
+    registros ou quando `batch_window` segundos se passam desde o primeiro.
+    """
+
+    def __init__(self, blockchain, batch_size, batch_window):
+        self.blockchain = blockchain
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._registros = []
+        self._placeholders = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, establishment_data, placeholder_id):
+        """Adiciona um registro ao lote atual.
+
+        Lança queue.Full se este registro completar o lote e não houver vaga
+        na fila de mineração (os registros do lote ficam como 'failed').
+        """
+        lote = None
+        with self._lock:
+            self._registros.append(establishment_data)
+            self._placeholders.append(placeholder_id)
+            if len(self._registros) >= self.batch_size:
+                lote = self._retirar_lote()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.batch_window, self._flush_pelo_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        # Fora do lock: a espera por vaga na fila não trava os outros cadastros
+        self._enviar_lote(lote)
+
+    def flush(self):
+        """Envia o lote atual para mineração, mesmo incompleto"""
+        with self._lock:
+            lote = self._retirar_lote()
+        self._enviar_lote(lote)
+
+    def _flush_pelo_timer(self):
+        try:
+            self.flush()
+        except queue.Full:
+            # Os registros do lote já foram marcados como 'failed'
+            pass
+
+    def _retirar_lote(self):
+        """Esvazia o lote atual; retorna (registros, placeholders) ou None"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._registros:
+            return None
+        lote = self._registros, self._placeholders
+        self._registros, self._placeholders = [], []
+        return lote
+
+    def _enviar_lote(self, lote):
+        if lote is None:
+            return
+        registros, placeholders = lote
+        self.blockchain.submit_mining(self.blockchain.add_establishments_batch, (registros, placeholders), placeholders)
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher(blockchain):
+    """Retorna o agrupador de cadastros do processo, criando-o na primeira chamada"""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = EstablishmentBatcher(blockchain, blockchain.batch_size, blockchain.batch_window)
+        return _batcher
+
+def _chave_hex(valor):
+    """Chave dos índices em memória para um hash ou id em hexadecimal.
+
+    Guarda os bytes do valor (metade do tamanho do texto); valores que não
+    são hexadecimal minúsculo ficam como estão.
+    """
+    if isinstance(valor, str):
+        try:
+            chave = bytes.fromhex(valor)
+        except ValueError:
+            return valor
+        if chave.hex() == valor:
+            return chave
+    return valor
+
+
+def connect_database():
+    """Conecta ao MongoDB configurado no .env e retorna o banco da aplicação"""
+    # Carregar variáveis de ambiente
+    load_dotenv()
+    
+    # Conectar ao MongoDB
+    uri = os.getenv('MONGO_URI')
+    
+    try:
+        client = MongoClient(uri, server_api=ServerApi('1'))
+    except Exception:
+        client = MongoClient(uri)
+    
+    return client['banco_estabelecimentos']
+
 
 class EstablishmentBlockchain:
     def __init__(self):
-        # Carregar variáveis de ambiente
-        load_dotenv()
-        
-        # Conectar ao MongoDB
-        uri = os.getenv('MONGO_URI')
-        
-        try:
-            self.client = MongoClient(uri, server_api=ServerApi('1'))
-        except Exception:
-            self.client = MongoClient(uri)
-            
-        self.db = self.client['banco_estabelecimentos']
+        self.db = connect_database()
+        self.client = self.db.client
         self.blockchain_collection = self.db['blockchain']
-        self.difficulty = 6
+        # Metadados da blockchain (checkpoint de validação)
+        self.meta_collection = self.db['blockchain_meta']
+        # Resultados das auditorias completas (resumo e erros por bloco)
+        self.audit_collection = self.db['blockchain_auditorias']
+        self.audit_errors_collection = self.db['blockchain_auditoria_erros']
+        self.audit_ttl = int(os.getenv('BLOCKCHAIN_AUDIT_TTL', 86400))
+        # Dificuldade em bits zero iniciais, ajustada para o tempo alvo por bloco
+        self.difficulty_bits = int(os.getenv('BLOCKCHAIN_DIFFICULTY_BITS', DIFICULDADE_LEGADA_BITS))
+        self.min_difficulty_bits = int(os.getenv('BLOCKCHAIN_MIN_DIFFICULTY_BITS', 16))
+        self.max_difficulty_bits = int(os.getenv('BLOCKCHAIN_MAX_DIFFICULTY_BITS', 40))
+        # Tempo alvo de mineração em segundos (0 = dificuldade fixa)
+        self.target_block_time = float(os.getenv('BLOCKCHAIN_TARGET_BLOCK_TIME', 10))
+        self.retarget_window = int(os.getenv('BLOCKCHAIN_RETARGET_WINDOW', 10))
+        # Tamanho mínimo da chain para auditar em vários processos
+        self.parallel_audit_min = int(os.getenv('BLOCKCHAIN_PARALLEL_AUDIT_MIN', 5000))
+        # Modo em lote: mais de um estabelecimento por bloco (1 = desativado)
+        self.batch_size = int(os.getenv('BLOCKCHAIN_BATCH_SIZE', 1))
+        self.batch_window = float(os.getenv('BLOCKCHAIN_BATCH_WINDOW', 5))
+        # Operações por chamada a bulk_write nas gravações em massa
+        self.bulk_batch_size = int(os.getenv('BLOCKCHAIN_BULK_BATCH_SIZE', 1000))
+        # Chain compacta: cabeçalhos em colunas e dados dos estabelecimentos sob demanda
+        self.compact_chain = os.getenv('BLOCKCHAIN_COMPACT_CHAIN', 'false').lower() == 'true'
+        self.chain_cache_size = int(os.getenv('BLOCKCHAIN_CHAIN_CACHE_SIZE', 1000))
+        # Modo leve: carregar só os cabeçalhos; dados dos blocos apenas quando inspecionados
+        self.light_chain = os.getenv('BLOCKCHAIN_LIGHT_CHAIN', 'false').lower() == 'true'
+        # Snapshot binário usado para carregar a chain sem ler todos os blocos do banco
+        self.snapshot_path = os.getenv('BLOCKCHAIN_SNAPSHOT')
+        # A instância é compartilhada entre as threads das requisições
+        self._lock = threading.RLock()
+        self.ensure_indexes()
         self.chain = self.load_chain_from_db()
+        self.checkpoint = self.load_checkpoint()
+        # Última validação da chain em memória: (altura verificada, válida) ou None
+        self._validity = None
+
+    def ensure_indexes(self):
+        """Cria os índices usados pelas consultas da blockchain no MongoDB"""
+        try:
+            # Registros pendentes (sem hash) não entram no índice único
+            self.blockchain_collection.create_index(
+                'index', unique=True,
+                partialFilterExpression={'hash': {'$exists': True}}
+            )
+            self.blockchain_collection.create_index('hash')
+            self.blockchain_collection.create_index([('establishment_data.establishment_id', 1), ('status', 1)])
+            self.blockchain_collection.create_index('establishment_data.establishments.establishment_id')
+            self.blockchain_collection.create_index('status')
+            self.audit_errors_collection.create_index([('auditoria_id', 1), ('index', 1)])
+            # Auditorias antigas são removidas automaticamente pelo MongoDB
+            self.audit_collection.create_index('created_at', expireAfterSeconds=self.audit_ttl)
+            self.audit_errors_collection.create_index('created_at', expireAfterSeconds=self.audit_ttl)
+        except Exception as e:
+            print(f"Erro ao criar índices da blockchain: {str(e)}")
+
+    def _index_block(self, block, posicao):
+        """Registra o bloco nos índices em memória"""
+        self._index_record(block.hash, block.establishment_data, posicao)
+
+    def _chave_indice(self, valor):
+        """Chave de um hash ou id nos índices em memória.
+
+        Na chain compacta os blocos não guardam o texto dos hashes e ids, então
+        a chave é convertida para bytes (metade do tamanho); nos outros modos o
+        próprio texto, já mantido pelo bloco, é a chave.
+        """
+        return _chave_hex(valor) if self.compact_chain else valor
+
+    def _index_record(self, block_hash, establishment_data, posicao):
+        """Registra nos índices em memória o hash e os estabelecimentos de um bloco"""
+        self._positions_by_hash[self._chave_indice(block_hash)] = posicao
+        if isinstance(establishment_data, dict) and 'establishments' in establishment_data:
+            for registro in establishment_data['establishments']:
+                self._positions_by_establishment[self._chave_indice(registro.get('establishment_id'))] = posicao
+        elif isinstance(establishment_data, dict) and 'establishment_id' in establishment_data:
+            self._positions_by_establishment[self._chave_indice(establishment_data['establishment_id'])] = posicao
+
+    def _append_document(self, chain, block_data):
+        """Adiciona à chain um bloco lido do banco (só o cabeçalho no modo leve)"""
+        if self.light_chain:
+            block = self.block_from_header(block_data)
+        else:
+            block = self.block_from_document(block_data)
+        chain.append(block)
+        # No modo leve o documento traz apenas os ids dos estabelecimentos
+        self._index_record(block_data['hash'], block_data.get('establishment_data'), len(chain) - 1)
+
+    def new_chain(self):
+        """Cria a estrutura vazia da chain em memória (lista ou chain compacta)"""
+        if self.compact_chain:
+            return CompactChain(self.blockchain_collection, self.block_from_document, self.chain_cache_size)
+        return []
 
     def load_chain_from_db(self):
-        # Carrega blockchain do MongoDB
-        chain = []
-        blocks = self.blockchain_collection.find().sort('index')
+        """Carrega blockchain do MongoDB (apenas blocos já minerados).
+
+        Também reconstrói os índices em memória (establishment_id e hash ->
+        posição na chain) na mesma leitura, enquanto os dados estão disponíveis.
+        """
+        chain = self.new_chain()
+        self._positions_by_establishment = {}
+        self._positions_by_hash = {}
+        proximo_indice = 0
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            proximo_indice = self.load_snapshot(chain)
+            if not proximo_indice and len(chain):
+                # Snapshot lido pela metade: recomeçar e carregar tudo do banco
+                chain = self.new_chain()
+                self._positions_by_establishment = {}
+                self._positions_by_hash = {}
+        
+        # Sem snapshot, todos os blocos; com snapshot, apenas os posteriores a ele
+        blocks = self.blockchain_collection.find({
+            'hash': {'$exists': True},
+            'index': {'$gte': proximo_indice}
+        }, self.load_projection()).sort('index')
         
         for block_data in blocks:
-            block = Block(
-                block_data['index'],
-                block_data['timestamp'],
-                block_data['establishment_data'],
-                block_data['previous_hash']
-            )
-            block.nonce = block_data['nonce']
-            block.hash = block_data['hash']
-            chain.append(block)
+            self._append_document(chain, block_data)
         
         if not chain:
             # Criar bloco genesis se a chain estiver vazia
             genesis_block = self.create_genesis_block()
             self.blockchain_collection.insert_one(genesis_block.to_dict())
             chain.append(genesis_block)
+            self._index_block(genesis_block, 0)
         
         return chain
 
+    def load_snapshot(self, chain):
+        """Carrega na chain os blocos do snapshot configurado.
+
+        O snapshot só é usado se o último bloco dele estiver no banco com o
+        mesmo hash. Retorna o índice do próximo bloco a buscar no banco
+        (0 se o snapshot não puder ser usado).
+        """
+        try:
+            with snapshot.SnapshotReader(self.snapshot_path) as leitor:
+                if not len(leitor):
+                    return 0
+                ultimo = leitor.cabecalho(len(leitor) - 1)
+                no_banco = self.blockchain_collection.find_one(
+                    {'index': ultimo['index'], 'hash': {'$exists': True}},
+                    {'hash': 1}
+                )
+                if no_banco is None or no_banco['hash'] != ultimo['hash']:
+                    print(f"Snapshot {self.snapshot_path} não corresponde à blockchain do banco; ignorando")
+                    return 0
+                for documento in leitor.documentos():
+                    self._append_document(chain, documento)
+                print(f"{len(leitor)} blocos carregados do snapshot {self.snapshot_path}")
+                return ultimo['index'] + 1
+        except (OSError, ValueError) as e:
+            print(f"Erro ao ler o snapshot da blockchain: {str(e)}")
+            return 0
+
+    def sync(self):
+        """Busca no banco apenas os blocos posteriores ao último bloco em memória.
+
+        Retorna a quantidade de blocos adicionados à chain.
+        """
+        with self._lock:
+            ultimo_indice = self.chain[-1].index
+            blocks = self.blockchain_collection.find({
+                'index': {'$gt': ultimo_indice},
+                'hash': {'$exists': True}
+            }, self.load_projection()).sort('index')
+            
+            novos = 0
+            for block_data in blocks:
+                # Ignorar documentos duplicados ou fora de sequência
+                if block_data['index'] != self.chain[-1].index + 1:
+                    continue
+                self._append_document(self.chain, block_data)
+                novos += 1
+            return novos
+
+    def reload_block(self, index):
+        """Relê do banco um bloco já carregado (ex.: após alteração direta no documento)"""
+        self.reload_blocks([index])
+
+    def reload_blocks(self, indices):
+        """Relê do banco, em uma única consulta, blocos já carregados"""
+        indices = list(indices)
+        if not indices:
+            return
+        with self._lock:
+            blocks = self.blockchain_collection.find({'index': {'$in': indices}, 'hash': {'$exists': True}})
+            for block_data in blocks:
+                index = block_data['index']
+                if not 0 <= index < len(self.chain):
+                    continue
+                block = self.block_from_document(block_data)
+                self.chain[index] = block
+                # Entradas antigas são descartadas na consulta, que confere o bloco
+                self._index_block(block, index)
+            # Os blocos mudaram no banco: revalidar a partir do primeiro deles
+            self._validity = None
+            self.invalidate_checkpoint(min(indices) - 1)
+
+    def bulk_writer(self, ordered=False, total=None, progresso=None):
+        """Cria um BulkWriter para a coleção da blockchain com o lote configurado"""
+        return BulkWriter(self.blockchain_collection, self.bulk_batch_size, ordered=ordered,
+                          progresso=progresso, total=total)
+
+    def update_blocks(self, atualizacoes):
+        """Aplica {índice: campos} aos blocos minerados em lotes e os relê do banco.
+
+        Cada operação altera um bloco diferente, então os lotes são enviados
+        sem ordem. Não recalcula hashes (usado na demonstração de adulteração).
+        """
+        with self.bulk_writer(total=len(atualizacoes)) as writer:
+            for index, campos in atualizacoes.items():
+                writer.update_one({'index': index, 'hash': {'$exists': True}}, {'$set': campos})
+        self.reload_blocks(atualizacoes.keys())
+        return writer.resultado['modified']
+
+    def restore_hashes(self, progresso=imprimir_progresso):
+        """Regrava o hash de cada bloco com o valor recalculado a partir dos dados.
+
+        Só blocos cujo hash difere do recalculado são gravados, em lotes
+        de `bulk_batch_size` operações. Retorna a quantidade de blocos alterados.
+        """
+        with self._lock:
+            chain = self.chain
+            total = len(chain)
+        with self.bulk_writer(progresso=progresso) as writer:
+            for block in itertools.islice(chain, total):
+                hash_calculado = block.calculate_hash()
+                if block.hash != hash_calculado:
+                    writer.update_one(
+                        {'index': block.index, 'hash': {'$exists': True}},
+                        {'$set': {'hash': hash_calculado}}
+                    )
+        self.reload_chain()
+        return writer.enviadas
+
+    def reload_chain(self):
+        """Descarta a chain em memória e a carrega novamente do banco"""
+        with self._lock:
+            self.chain = self.load_chain_from_db()
+            self._validity = None
+            self.invalidate_checkpoint()
+
+    def watch_changes(self):
+        """Acompanha a coleção por change stream e mantém a chain em dia.
+
+        Requer MongoDB em replica set; sem suporte, a chain continua sendo
+        atualizada por sync() nas requisições.
+        """
+        def acompanhar():
+            try:
+                with self.blockchain_collection.watch(full_document='updateLookup') as stream:
+                    for change in stream:
+                        documento = change.get('fullDocument') or {}
+                        if 'hash' not in documento:
+                            continue
+                        if documento['index'] < len(self.chain):
+                            self.reload_block(documento['index'])
+                        else:
+                            self.sync()
+            except Exception as e:
+                print(f"Change stream da blockchain indisponível: {str(e)}")
+        
+        thread = threading.Thread(target=acompanhar, name='blockchain-change-stream', daemon=True)
+        thread.start()
+        return thread
+
+    def block_from_document(self, block_data):
+        """Reconstrói um Block a partir do documento salvo no MongoDB"""
+        return Block.from_document(block_data)
+
+    def load_projection(self):
+        """Campos lidos ao carregar a chain (None = documento inteiro)"""
+        return PROJECAO_CABECALHO if self.light_chain else None
+
+    def block_from_header(self, block_data):
+        """Reconstrói um Block só com o cabeçalho; os dados são lidos no primeiro acesso"""
+        index = block_data['index']
+
+        def carregar_dados():
+            documento = self.blockchain_collection.find_one(
+                {'index': index, 'hash': {'$exists': True}},
+                {'establishment_data': 1}
+            )
+            return documento.get('establishment_data') if documento else None
+
+        return Block.from_header(block_data, carregar_dados)
+
+    def get_blocks(self, inicio, fim, chain=None, somente_cabecalho=False):
+        """Blocos das posições [inicio, fim) com os dados carregados.
+
+        No modo leve os dados de todos os blocos do trecho vêm de uma única
+        consulta, em cópias completas: os blocos da chain continuam só com o
+        cabeçalho e o hash é recalculado a partir dos dados, não do digest.
+        Com `somente_cabecalho`, só são completados os blocos que precisam
+        dos dados para calcular o hash.
+        """
+        chain = self.chain if chain is None else chain
+        blocks = chain[inicio:fim]
+        if somente_cabecalho:
+            faltando = [block.index for block in blocks if block.header_needs_data()]
+        else:
+            faltando = [block.index for block in blocks if not block.data_loaded()]
+        if not faltando:
+            return blocks
+        documentos = self.blockchain_collection.find(
+            {'index': {'$in': faltando}, 'hash': {'$exists': True}},
+            {'index': 1, 'establishment_data': 1}
+        )
+        dados = {documento['index']: documento.get('establishment_data') for documento in documentos}
+        completos = []
+        for block in blocks:
+            if block.index in dados:
+                documento = block.header_dict()
+                documento['establishment_data'] = dados[block.index]
+                block = self.block_from_document(documento)
+            completos.append(block)
+        return completos
+
     def create_genesis_block(self):
         """Cria o bloco genesis da blockchain"""
         genesis_block = Block(0, str(datetime.datetime.now()), "Genesis Block", "0")
         # Mine the genesis block to ensure it passes validation
         print("Minerando bloco genesis...")
-        genesis_block.mine_block(self.difficulty)
+        if not genesis_block.mine_block(self.difficulty_bits):
+            raise RuntimeError('Mineração do bloco genesis interrompida')
         print(f"Bloco genesis minerado com hash: {genesis_block.hash}")
         return genesis_block
 
@@ -139,6 +856,16 @@ class EstablishmentBlockchain:
         """Retorna o último bloco da chain"""
         return self.chain[-1]
 
+    def get_latest_mined_block(self):
+        """Retorna o último bloco minerado no banco, inclusive por outras instâncias"""
+        block_data = self.blockchain_collection.find_one(
+            {'hash': {'$exists': True}},
+            sort=[('index', -1)]
+        )
+        if block_data is None:
+            return self.get_latest_block()
+        return self.block_from_document(block_data)
+
     def add_establishment(self, establishment_data):
         """Adiciona um novo estabelecimento à blockchain"""
         previous_block = self.get_latest_block()
@@ -149,30 +876,70 @@ class EstablishmentBlockchain:
             previous_block.hash
         )
         
+        block_data = self.mine_with_metadata(new_block)
+        
+        # Gravar no banco e trazer o bloco para a chain em memória
+        self.blockchain_collection.insert_one(block_data)
+        self.sync()
+        return new_block
+
+    def next_difficulty_bits(self):
+        """Calcula a dificuldade (em bits) do próximo bloco pelos últimos tempos de mineração"""
+        recentes = list(self.blockchain_collection.find(
+            {'hash': {'$exists': True}, 'mining_duration': {'$exists': True}},
+            {'mining_duration': 1, 'difficulty_bits': 1}
+        ).sort('index', -1).limit(max(self.retarget_window, 1)))
+        if not recentes:
+            return self.difficulty_bits
+        
+        ultimo_bits = recentes[0].get('difficulty_bits', DIFICULDADE_LEGADA_BITS)
+        if self.target_block_time <= 0:
+            return self.difficulty_bits
+        
+        # Normalizar cada tempo para a dificuldade do último bloco (cada bit dobra o trabalho)
+        tempos = [
+            doc['mining_duration'] * 2 ** (ultimo_bits - doc.get('difficulty_bits', DIFICULDADE_LEGADA_BITS))
+            for doc in recentes
+        ]
+        tempo_medio = sum(tempos) / len(tempos)
+        if tempo_medio <= 0:
+            ajuste = AJUSTE_MAXIMO_BITS
+        else:
+            ajuste = round(math.log2(self.target_block_time / tempo_medio))
+        ajuste = max(-AJUSTE_MAXIMO_BITS, min(AJUSTE_MAXIMO_BITS, ajuste))
+        
+        return max(self.min_difficulty_bits, min(self.max_difficulty_bits, ultimo_bits + ajuste))
+
+    def mine_with_metadata(self, new_block):
+        """Minera o bloco e retorna seu documento com os tempos de mineração"""
         # Registrar tempo de início da mineração
         hora_inicio = datetime.datetime.now()
         print(f"Iniciando mineração do bloco em: {hora_inicio.strftime('%Y-%m-%d %H:%M:%S')}")
         
-        # Minerar o bloco
-        new_block.mine_block(self.difficulty)
+        # Minerar o bloco com a dificuldade ajustada aos tempos recentes
+        if not new_block.mine_block(self.next_difficulty_bits()):
+            # Nunca gravar um bloco sem prova de trabalho válida
+            raise RuntimeError('Mineração interrompida antes de encontrar uma solução')
         
         # Registrar tempo de fim da mineração
         hora_fim = datetime.datetime.now()
         print(f"Mineração concluída em: {hora_fim.strftime('%Y-%m-%d %H:%M:%S')}")
         print(f"Tempo total de mineração: {(hora_fim - hora_inicio).total_seconds()} segundos")
         
-        # Adicionar bloco à chain e ao banco de dados
-        self.chain.append(new_block)
         block_data = new_block.to_dict()
         block_data['mining_start'] = hora_inicio.strftime('%Y-%m-%d %H:%M:%S')
         block_data['mining_end'] = hora_fim.strftime('%Y-%m-%d %H:%M:%S')
         block_data['mining_duration'] = (hora_fim - hora_inicio).total_seconds()
-        
-        self.blockchain_collection.insert_one(block_data)
-        return new_block
+        return block_data
         
     def add_establishment_async(self, establishment_data):
-        """Adiciona um novo estabelecimento à blockchain de forma assíncrona"""
+        """Adiciona um novo estabelecimento à blockchain de forma assíncrona.
+
+        Lança queue.Full se não houver vaga na fila de mineração.
+        """
+        if self.batch_size > 1:
+            return self._add_establishment_to_batch(establishment_data)
+
         # Criar um registro temporário na blockchain com status 'pending'
         previous_block = self.get_latest_block()
         new_block_index = len(self.chain)
@@ -190,56 +957,36 @@ class EstablishmentBlockchain:
         # Inserir o registro temporário
         temp_block_id = self.blockchain_collection.insert_one(temp_block_data).inserted_id
         
-        # Iniciar a mineração em uma thread separada
+        # Enfileirar a mineração no serviço de mineração do processo
         def mine_in_background():
             try:
-                # Criar o bloco
+                # O bloco anterior só é conhecido quando o trabalho sai da fila:
+                # outros cadastros enfileirados antes podem ter estendido a chain
+                previous_block = self.get_latest_mined_block()
                 new_block = Block(
-                    new_block_index,
+                    previous_block.index + 1,
                     temp_block_data['timestamp'],
                     establishment_data,
                     previous_block.hash
                 )
                 
-                # Registrar tempo de início da mineração
-                hora_inicio = datetime.datetime.now()
-                print(f"Iniciando mineração do bloco em: {hora_inicio.strftime('%Y-%m-%d %H:%M:%S')}")
-                
-                # Minerar o bloco
-                new_block.mine_block(self.difficulty)
-                
-                # Registrar tempo de fim da mineração
-                hora_fim = datetime.datetime.now()
-                print(f"Mineração concluída em: {hora_fim.strftime('%Y-%m-%d %H:%M:%S')}")
-                print(f"Tempo total de mineração: {(hora_fim - hora_inicio).total_seconds()} segundos")
-                
-                # Adicionar bloco à chain
-                self.chain.append(new_block)
-                
-                # Atualizar registro
-                block_data = new_block.to_dict()
-                block_data['mining_start'] = hora_inicio.strftime('%Y-%m-%d %H:%M:%S')
-                block_data['mining_end'] = hora_fim.strftime('%Y-%m-%d %H:%M:%S')
-                block_data['mining_duration'] = (hora_fim - hora_inicio).total_seconds()
+                block_data = self.mine_with_metadata(new_block)
                 block_data['status'] = 'completed'
                 
+                # Atualizar registro e trazer o bloco para a chain em memória
                 self.blockchain_collection.update_one(
                     {'_id': temp_block_id},
                     {'$set': block_data}
                 )
+                self.sync()
                 
-                print(f"Bloco {new_block_index} adicionado à blockchain com sucesso!")
+                print(f"Bloco {new_block.index} adicionado à blockchain com sucesso!")
             except Exception as e:
                 print(f"Erro durante a mineração do bloco: {str(e)}")
                 # Atualizar o status para 'failed' em caso de erro
-                self.blockchain_collection.update_one(
-                    {'_id': temp_block_id},
-                    {'$set': {'status': 'failed', 'error': str(e)}}
-                )
+                self.mark_failed([temp_block_id], str(e))
         
-        # Iniciar a thread de mineração
-        executor = ThreadPoolExecutor(max_workers=1)
-        executor.submit(mine_in_background)
+        self.submit_mining(mine_in_background, (), [temp_block_id])
         
         return {
             'status': 'pending',
@@ -247,90 +994,439 @@ class EstablishmentBlockchain:
             'block_index': new_block_index
         }
 
+    def submit_mining(self, fn, args, placeholder_ids):
+        """Envia um trabalho ao serviço de mineração.
+
+        Se a fila continuar cheia após a espera do serviço, os registros
+        pendentes `placeholder_ids` são marcados como 'failed' e queue.Full é
+        lançada, para que a rota responda 503 em vez de travar.
+        """
+        try:
+            return mining.get_mining_service().submit(fn, *args)
+        except queue.Full:
+            print(f"Fila de mineração cheia: {len(placeholder_ids)} registros marcados como 'failed'")
+            self.mark_failed(placeholder_ids, 'Fila de mineração cheia')
+            raise
+
+    def mark_failed(self, placeholder_ids, erro):
+        """Marca os registros pendentes como 'failed' com a mensagem de erro"""
+        if not placeholder_ids:
+            return
+        self.blockchain_collection.update_many(
+            {'_id': {'$in': list(placeholder_ids)}},
+            {'$set': {'status': 'failed', 'error': erro}}
+        )
+
+    def _add_establishment_to_batch(self, establishment_data):
+        """Registra o estabelecimento como pendente e o coloca no lote atual"""
+        placeholder = {
+            'timestamp': str(datetime.datetime.now()),
+            'establishment_data': establishment_data,
+            'status': 'pending',
+            'batch': True,
+            'mining_start': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        placeholder_id = self.blockchain_collection.insert_one(placeholder).inserted_id
+        get_batcher(self).add(establishment_data, placeholder_id)
+        
+        return {
+            'status': 'pending',
+            'message': 'Estabelecimento adicionado. Aguardando lote para mineração em segundo plano.',
+            'block_index': None
+        }
+
+    def add_establishments_batch_async(self, establishments):
+        """Registra vários estabelecimentos como pendentes e minera todos em um único bloco em segundo plano.
+
+        Lança queue.Full se não houver vaga na fila de mineração.
+        """
+        agora = datetime.datetime.now()
+        placeholders = [{
+            'timestamp': str(agora),
+            'establishment_data': establishment_data,
+            'status': 'pending',
+            'batch': True,
+            'mining_start': agora.strftime('%Y-%m-%d %H:%M:%S')
+        } for establishment_data in establishments]
+        placeholder_ids = self.blockchain_collection.insert_many(placeholders).inserted_ids
+        self.submit_mining(self.add_establishments_batch, (list(establishments), placeholder_ids), placeholder_ids)
+
+        return {
+            'status': 'pending',
+            'message': f'{len(placeholder_ids)} estabelecimentos adicionados. Mineração do bloco iniciada em segundo plano.',
+            'block_index': None
+        }
+
+    def add_establishments_batch(self, establishments, placeholder_ids=None):
+        """Minera um único bloco com vários estabelecimentos"""
+        placeholder_ids = placeholder_ids or []
+        try:
+            previous_block = self.get_latest_mined_block()
+            new_block = Block(
+                previous_block.index + 1,
+                str(datetime.datetime.now()),
+                {'establishments': list(establishments)},
+                previous_block.hash
+            )
+            
+            block_data = self.mine_with_metadata(new_block)
+            block_data['status'] = 'completed'
+            
+            # O bloco substitui os registros pendentes de cada estabelecimento,
+            # na mesma ida ao banco e nessa ordem
+            with self.bulk_writer(ordered=True) as writer:
+                writer.insert_one(block_data)
+                if placeholder_ids:
+                    writer.delete_many({'_id': {'$in': placeholder_ids}})
+            self.sync()
+            
+            print(f"Bloco {new_block.index} com {len(establishments)} estabelecimentos adicionado à blockchain com sucesso!")
+            return new_block
+        except Exception as e:
+            print(f"Erro durante a mineração do lote: {str(e)}")
+            self.mark_failed(placeholder_ids, str(e))
+            raise
+
     def find_establishment_block(self, establishment_id):
         """Encontra o bloco de um estabelecimento específico"""
-        for block in self.chain:
-            if isinstance(block.establishment_data, dict) and \
-               block.establishment_data.get('establishment_id') == establishment_id:
-                return block
-        return None
+        posicao = self._positions_by_establishment.get(self._chave_indice(establishment_id))
+        if posicao is None or posicao >= len(self.chain):
+            return None
+        block = self.chain[posicao]
+        # Conferir o registro: o bloco pode ter sido alterado no banco
+        if block.find_record(establishment_id) is None:
+            return None
+        return block
 
-    def is_chain_valid(self):
-        """Valida toda a cadeia blockchain"""
-        # If the blockchain has only the genesis block, it's valid
-        if len(self.chain) <= 1:
-            return True
-            
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i-1]
+    def find_block_by_hash(self, block_hash):
+        """Encontra um bloco da chain pelo seu hash"""
+        posicao = self._positions_by_hash.get(self._chave_indice(block_hash))
+        if posicao is None or posicao >= len(self.chain) or self.chain[posicao].hash != block_hash:
+            return None
+        return self.chain[posicao]
 
-            # Verificar hash atual
-            if current_block.hash != current_block.calculate_hash():
-                return False
+    def is_chain_valid(self, full=False):
+        """Valida a cadeia blockchain.
 
-            # Verificar ligação com bloco anterior
-            if current_block.previous_hash != previous_block.hash:
+        Por padrão só verifica os blocos posteriores ao último checkpoint de
+        validação; com full=True audita a chain inteira a partir do bloco 1.
+        """
+        with self._lock:
+            chain = self.chain
+            # If the blockchain has only the genesis block, it's valid
+            if len(chain) <= 1:
+                self._validity = (len(chain), True)
+                return True
+            
+            inicio = 1
+            checkpoint = self.checkpoint
+            if not full and checkpoint and checkpoint['height'] < len(chain) and \
+                    chain[checkpoint['height']].hash == checkpoint['hash']:
+                inicio = checkpoint['height'] + 1
+            
+            invalido = self._first_invalid_block(chain, inicio, len(chain))
+            if invalido is not None:
+                # O checkpoint não pode ficar acima de um bloco inválido
+                self.invalidate_checkpoint(invalido - 1)
+                self._validity = (len(chain), False)
                 return False
 
-            # Verificar prova de trabalho
-            if current_block.hash[:self.difficulty] != "0" * self.difficulty:
+            if not checkpoint or checkpoint['height'] != len(chain) - 1:
+                self.save_checkpoint(len(chain) - 1)
+            self._validity = (len(chain), True)
+            return True
+
+    def cached_chain_validity(self):
+        """Validade da chain sem acessar o banco quando já foi calculada.
+
+        Blocos adicionados desde a última validação são verificados em
+        memória; o resultado só é recalculado do zero após reload_block ou
+        reload_chain.
+        """
+        with self._lock:
+            if self._validity is None:
+                return self.is_chain_valid()
+            altura, valida = self._validity
+            chain = self.chain
+            if not valida or altura >= len(chain):
+                return valida
+            if self._first_invalid_block(chain, max(altura, 1), len(chain)) is not None:
+                self._validity = (len(chain), False)
                 return False
+            self._validity = (len(chain), True)
+            return True
+
+    def _first_invalid_block(self, chain, inicio, fim):
+        """Posição do primeiro bloco inválido em [inicio, fim), ou None.
+
+        Lê a chain em trechos; só os blocos cujo cabeçalho depende dos dados
+        (versão 1 no modo leve) são buscados no banco, um trecho por consulta.
+        """
+        for trecho_inicio in range(inicio, fim, TAMANHO_TRECHO_AUDITORIA):
+            trecho_fim = min(trecho_inicio + TAMANHO_TRECHO_AUDITORIA, fim)
+            blocks = self.get_blocks(trecho_inicio - 1, trecho_fim, chain, somente_cabecalho=True)
+            for posicao in range(1, len(blocks)):
+                if not self.is_block_valid(blocks[posicao], blocks[posicao - 1]):
+                    return trecho_inicio + posicao - 1
+        return None
+
+    def is_block_valid(self, current_block, previous_block):
+        """Verifica um bloco em relação ao seu antecessor"""
+        # Verificar hash atual
+        if current_block.hash != current_block.calculate_hash():
+            return False
+
+        # Verificar ligação com bloco anterior
+        if current_block.previous_hash != previous_block.hash:
+            return False
+
+        # Verificar prova de trabalho com a dificuldade do próprio bloco
+        if current_block.difficulty_bits < current_block.required_difficulty_bits(self.min_difficulty_bits) or \
+                not current_block.meets_difficulty():
+            return False
 
         return True
 
+    def load_checkpoint(self):
+        """Lê o checkpoint de validação persistido (altura e hash do último bloco verificado)"""
+        documento = self.meta_collection.find_one({'_id': 'validation_checkpoint'})
+        if not documento:
+            return None
+        return {'height': documento['height'], 'hash': documento['hash']}
+
+    def save_checkpoint(self, height):
+        """Registra que a chain foi verificada até a altura informada"""
+        with self._lock:
+            self.checkpoint = {'height': height, 'hash': self.chain[height].hash}
+            self.meta_collection.update_one(
+                {'_id': 'validation_checkpoint'},
+                {'$set': dict(self.checkpoint, verified_at=str(datetime.datetime.now()))},
+                upsert=True
+            )
+
+    def invalidate_checkpoint(self, height=None):
+        """Recua o checkpoint para no máximo `height` (None força auditoria completa)"""
+        with self._lock:
+            if self.checkpoint is None:
+                return
+            if height is not None and height >= 1:
+                if self.checkpoint['height'] > height:
+                    self.save_checkpoint(height)
+                return
+            self.checkpoint = None
+            self.meta_collection.delete_one({'_id': 'validation_checkpoint'})
+
+    def iter_audit(self, parallel=None):
+        """Auditoria completa produzida aos poucos, na ordem dos blocos.
+
+        Gera (último índice verificado, total de blocos, [(índice, erros)])
+        a cada trecho auditado. Chains com pelo menos `parallel_audit_min`
+        blocos são auditadas em vários processos. Ao terminar, o checkpoint
+        de validação e a validade em cache são atualizados.
+        """
+        with self._lock:
+            # Os blocos são lidos por fatias: a chain compacta não é materializada inteira
+            chain = self.chain
+            total = len(chain)
+        if parallel is None:
+            parallel = total >= self.parallel_audit_min
+        
+        primeiro_adulterado = None
+        if parallel and total > 2:
+            trechos = iter_audit_blocks(chain, self.min_difficulty_bits, total=total,
+                                        ler_blocos=lambda inicio, fim: self.get_blocks(inicio, fim, chain))
+        else:
+            trechos = self._iter_audit_serial(chain, total)
+        for ultimo, problemas in trechos:
+            if problemas and primeiro_adulterado is None:
+                primeiro_adulterado = problemas[0][0]
+            yield ultimo, total, problemas
+        
+        # Atualizar o checkpoint com o resultado da auditoria
+        if primeiro_adulterado is not None:
+            self.invalidate_checkpoint(primeiro_adulterado - 1)
+        elif chain is self.chain and total == len(self.chain):
+            self.save_checkpoint(total - 1)
+        if chain is self.chain:
+            self._validity = (total, primeiro_adulterado is None)
+
+    def _iter_audit_serial(self, chain, total):
+        """Audita no processo atual, em trechos de TAMANHO_TRECHO_AUDITORIA blocos"""
+        previous_hash = chain[0].hash
+        for inicio in range(1, total, TAMANHO_TRECHO_AUDITORIA):
+            blocks = self.get_blocks(inicio, min(inicio + TAMANHO_TRECHO_AUDITORIA, total), chain)
+            yield blocks[-1].index, _auditar_blocos(blocks, previous_hash, self.min_difficulty_bits)
+            previous_hash = blocks[-1].hash
+
+    def audit(self, parallel=None):
+        """Auditoria completa com a lista de erros de cada bloco.
+
+        Retorna (erros, conjunto de índices adulterados).
+        """
+        errors = []
+        tampered_blocks = set()
+        for _, _, problemas in self.iter_audit(parallel):
+            for index, block_errors in problemas:
+                errors.extend(block_errors)
+                tampered_blocks.add(index)
+        return errors, tampered_blocks
+
+    def run_audit(self, parallel=None):
+        """Executa a auditoria guardando o resultado no MongoDB.
+
+        Gera eventos (dicts) à medida que a auditoria avança: 'inicio' com o
+        id da auditoria, 'erro' para cada bloco adulterado, 'progresso' a cada
+        trecho e 'resumo' no final. Os erros ficam em `audit_errors_collection`
+        e o resumo em `audit_collection`, consultáveis pelo id da auditoria.
+        Se o gerador for fechado antes do fim, a auditoria fica com status
+        'aborted' e as contagens parciais.
+        """
+        criado_em = datetime.datetime.now()
+        auditoria_id = self.audit_collection.insert_one({
+            'status': 'running',
+            'created_at': criado_em,
+            'started_at': criado_em.strftime('%Y-%m-%d %H:%M:%S')
+        }).inserted_id
+        
+        blocos_adulterados = 0
+        total = 0
+        verificados = 0
+        try:
+            yield {'type': 'inicio', 'auditoria_id': str(auditoria_id)}
+            for ultimo, total, problemas in self.iter_audit(parallel):
+                if problemas:
+                    self.audit_errors_collection.insert_many([
+                        {'auditoria_id': auditoria_id, 'index': index, 'errors': block_errors,
+                         'created_at': criado_em}
+                        for index, block_errors in problemas
+                    ])
+                    blocos_adulterados += len(problemas)
+                for index, block_errors in problemas:
+                    yield {'type': 'erro', 'index': index, 'errors': block_errors}
+                verificados = ultimo
+                yield {'type': 'progresso', 'verificados': ultimo, 'total': total - 1}
+        except GeneratorExit:
+            # O consumidor parou no meio (ex.: cliente desconectou do stream)
+            self.audit_collection.update_one(
+                {'_id': auditoria_id},
+                {'$set': {
+                    'status': 'aborted',
+                    'tampered_count': blocos_adulterados,
+                    'verified_count': verificados,
+                    'block_count': total,
+                    'finished_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }}
+            )
+            raise
+        except Exception as e:
+            self.audit_collection.update_one(
+                {'_id': auditoria_id},
+                {'$set': {'status': 'failed', 'error': str(e)}}
+            )
+            raise
+        
+        resumo = {
+            'status': 'completed',
+            'valid': blocos_adulterados == 0,
+            'tampered_count': blocos_adulterados,
+            'block_count': total,
+            'finished_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        self.audit_collection.update_one({'_id': auditoria_id}, {'$set': resumo})
+        yield dict(resumo, type='resumo', auditoria_id=str(auditoria_id))
+
+    def get_audit(self, auditoria_id):
+        """Retorna o resumo de uma auditoria guardada, ou None"""
+        try:
+            auditoria_id = ObjectId(auditoria_id)
+        except (InvalidId, TypeError):
+            return None
+        return self.audit_collection.find_one({'_id': auditoria_id})
+
+    def get_audit_errors(self, auditoria_id, inicio=None, fim=None, limite=0):
+        """Blocos adulterados de uma auditoria, opcionalmente em uma faixa de índices"""
+        filtro = {'auditoria_id': auditoria_id}
+        if inicio is not None or fim is not None:
+            filtro['index'] = {}
+            if inicio is not None:
+                filtro['index']['$gte'] = inicio
+            if fim is not None:
+                filtro['index']['$lte'] = fim
+        return list(self.audit_errors_collection.find(filtro, {'_id': 0}).sort('index').limit(limite))
+
     def get_establishment_status(self, establishment_id):
-        """Retorna o status de um estabelecimento na blockchain"""
-        # Primeiro, verificar se existe um bloco pendente para este estabelecimento
-        pending_block = self.blockchain_collection.find_one({
-            'establishment_data.establishment_id': establishment_id,
-            'status': 'pending'
-        })
+        """Retorna o status de um estabelecimento na blockchain.
+
+        Faz uma única consulta indexada: o registro mais recente do
+        estabelecimento (pendente, com erro ou minerado, em bloco simples ou
+        em lote). A validade da chain vem do cache em memória.
+        """
+        block_data = self.blockchain_collection.find_one(
+            {'$or': [
+                {'establishment_data.establishment_id': establishment_id},
+                {'establishment_data.establishments.establishment_id': establishment_id}
+            ]},
+            {'_id': 0},
+            sort=[('_id', -1)]
+        )
+        is_valid = self.cached_chain_validity()
         
-        if pending_block:
+        if block_data is None:
+            return {
+                "status": "not_found",
+                "message": "Estabelecimento não encontrado na blockchain",
+                "chain_valid": is_valid
+            }
+        
+        if block_data.get('status') == 'pending':
             return {
                 "status": "pending",
                 "message": "Estabelecimento está sendo minerado na blockchain",
-                "block": pending_block
+                "block": block_data,
+                "chain_valid": is_valid
             }
         
-        # Verificar se existe um bloco com erro
-        failed_block = self.blockchain_collection.find_one({
-            'establishment_data.establishment_id': establishment_id,
-            'status': 'failed'
-        })
-        
-        if failed_block:
+        if block_data.get('status') == 'failed':
             return {
                 "status": "failed",
                 "message": "Houve um erro na mineração do bloco",
-                "block": failed_block,
-                "error": failed_block.get('error', 'Erro desconhecido')
-            }
-        
-        # Buscar o bloco completo
-        block = self.find_establishment_block(establishment_id)
-        if not block:
-            return {
-                "status": "not_found",
-                "message": "Estabelecimento não encontrado na blockchain"
+                "block": block_data,
+                "error": block_data.get('error', 'Erro desconhecido'),
+                "chain_valid": is_valid
             }
         
-        # Buscar dados do bloco com mining_duration
-        block_data = self.blockchain_collection.find_one({'hash': block.hash})
+        block = self.block_from_document(block_data)
         block_dict = block.to_dict()
         
         # Adicionar mining_duration se disponível
-        if block_data and 'mining_duration' in block_data:
+        if 'mining_duration' in block_data:
             block_dict['mining_duration'] = block_data['mining_duration']
         
-        is_valid = self.is_chain_valid()
-        return {
+        status = {
             "status": "valid" if is_valid else "invalid",
             "block": block_dict,
             "chain_valid": is_valid,
             "message": "Bloco válido na blockchain" if is_valid else "Blockchain corrompida"
         }
+        
+        # Blocos em lote: prova de que o registro está sob a raiz de Merkle
+        if block.is_batch():
+            status['inclusion_proof'] = block.inclusion_proof(establishment_id)
+        return status
+
+_blockchain = None
+_blockchain_lock = threading.Lock()
+
+
+def get_blockchain():
+    """Retorna a blockchain compartilhada do processo, carregando-a na primeira chamada"""
+    global _blockchain
+    with _blockchain_lock:
+        if _blockchain is None:
+            _blockchain = EstablishmentBlockchain()
+            if os.getenv('BLOCKCHAIN_CHANGE_STREAM', 'false').lower() == 'true':
+                _blockchain.watch_changes()
+        return _blockchain
 
 # Exemplo de uso
 if __name__ == "__main__":
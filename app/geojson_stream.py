@@ -0,0 +1,39 @@
+import json
+
+# orjson é opcional: quando instalado, codifica as features bem mais rápido
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Documentos lidos do cursor (e features codificadas) por pedaço da resposta
+TAMANHO_LOTE_STREAM = 1000
+
+
+def codificar_json(valor):
+    """JSON compacto em bytes, com orjson se disponível"""
+    if orjson is not None:
+        return orjson.dumps(valor)
+    return json.dumps(valor, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def stream_feature_collection(documentos, para_feature, tamanho_lote=TAMANHO_LOTE_STREAM):
+    """Gera uma FeatureCollection GeoJSON em pedaços de bytes.
+
+    Cada documento do iterável (ex.: cursor do MongoDB) vira uma feature com
+    `para_feature(documento)`; um pedaço é gerado a cada `tamanho_lote`
+    features, de modo que nem a lista de features nem o JSON completo ficam
+    em memória e o primeiro byte sai antes do fim da consulta.
+    """
+    yield b'{"type":"FeatureCollection","features":['
+    lote = []
+    primeiro = True
+    for documento in documentos:
+        lote.append(codificar_json(para_feature(documento)))
+        if len(lote) >= tamanho_lote:
+            yield (b'' if primeiro else b',') + b','.join(lote)
+            primeiro = False
+            lote = []
+    if lote:
+        yield (b'' if primeiro else b',') + b','.join(lote)
+    yield b']}'
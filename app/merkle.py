@@ -0,0 +1,88 @@
+import hashlib
+import json
+
+# Prefixos de separação de domínio: uma folha nunca tem o mesmo hash de um
+# nó interno, e a raiz final compromete a quantidade de folhas
+PREFIXO_FOLHA = b'\x00'
+PREFIXO_NO = b'\x01'
+PREFIXO_RAIZ = b'\x02'
+
+
+def serializar(registro):
+    """Serialização canônica (bytes) usada nos hashes.
+
+    JSON com chaves ordenadas e sem espaços, para que o resultado não dependa
+    da ordem das chaves do dicionário.
+    """
+    return json.dumps(registro, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str).encode('utf-8')
+
+
+def hash_registro(registro):
+    """Calcula o hash SHA256 (bytes) de um registro de estabelecimento"""
+    return hashlib.sha256(serializar(registro)).digest()
+
+
+def _hash_folha(registro):
+    return hashlib.sha256(PREFIXO_FOLHA + serializar(registro)).digest()
+
+
+def _hash_no(esquerda, direita):
+    return hashlib.sha256(PREFIXO_NO + esquerda + direita).digest()
+
+
+def _proximo_nivel(nivel):
+    """Combina os hashes de um nível da árvore dois a dois"""
+    proximo = [_hash_no(nivel[i], nivel[i + 1]) for i in range(0, len(nivel) - 1, 2)]
+    if len(nivel) % 2 == 1:
+        # O último hash sem par sobe para o nível seguinte sem alteração
+        proximo.append(nivel[-1])
+    return proximo
+
+
+def _raiz_final(raiz, quantidade):
+    return hashlib.sha256(PREFIXO_RAIZ + quantidade.to_bytes(8, 'big') + raiz).digest()
+
+
+def merkle_root(registros):
+    """Retorna a raiz de Merkle (hex) de uma lista de registros"""
+    nivel = [_hash_folha(registro) for registro in registros]
+    if not nivel:
+        return _raiz_final(hashlib.sha256(b'').digest(), 0).hex()
+    while len(nivel) > 1:
+        nivel = _proximo_nivel(nivel)
+    return _raiz_final(nivel[0], len(registros)).hex()
+
+
+def merkle_proof(registros, posicao):
+    """Retorna a prova de inclusão do registro na posição informada.
+
+    A prova é uma lista de {'hash', 'position'}, da folha até a raiz, onde
+    position indica de que lado o hash irmão entra na concatenação. Os níveis
+    em que o nó é promovido sem par não entram na prova.
+    """
+    nivel = [_hash_folha(registro) for registro in registros]
+    prova = []
+    while len(nivel) > 1:
+        if posicao % 2 == 0:
+            if posicao + 1 < len(nivel):
+                prova.append({'hash': nivel[posicao + 1].hex(), 'position': 'right'})
+        else:
+            prova.append({'hash': nivel[posicao - 1].hex(), 'position': 'left'})
+        nivel = _proximo_nivel(nivel)
+        posicao //= 2
+    return prova
+
+
+def verificar_prova(registro, prova, raiz, quantidade):
+    """Verifica se o registro pertence à árvore com a raiz informada.
+
+    `quantidade` é o número de folhas da árvore, comprometido na raiz.
+    """
+    atual = _hash_folha(registro)
+    for passo in prova:
+        irmao = bytes.fromhex(passo['hash'])
+        if passo['position'] == 'left':
+            atual = _hash_no(irmao, atual)
+        else:
+            atual = _hash_no(atual, irmao)
+    return _raiz_final(atual, quantidade).hex() == raiz
@@ -0,0 +1,310 @@
+import os
+import sys
+import atexit
+import queue
+import itertools
+import hashlib
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+
+# Quantidade de nonces que cada worker testa por tarefa
+TAMANHO_INTERVALO = 50000
+# A cada quantos nonces o worker confere se já existe solução melhor
+INTERVALO_VERIFICACAO = 4096
+
+SEM_SOLUCAO = sys.maxsize
+
+# Segundos que um envio espera por vaga na fila de mineração antes de desistir
+TEMPO_ESPERA_FILA = 5
+
+# Formas de executar a busca de nonces
+ESTRATEGIAS = ('serial', 'threads', 'processos')
+
+# Menor nonce válido encontrado até agora (compartilhado entre processos)
+_melhor_nonce = None
+
+
+def contexto_processos():
+    """Contexto dos pools de processos: forkserver (spawn onde não existir).
+
+    Os pools são criados em um processo com várias threads (Flask,
+    MongoClient); um fork copiaria locks que outra thread pode estar
+    segurando e o worker travaria. Os workers reimportam o módulo principal,
+    então a aplicação deve ser iniciada por app/__main__.py (`python app`).
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _inicializar_worker(melhor_nonce):
+    """Guarda no processo worker o valor compartilhado com o melhor nonce"""
+    global _melhor_nonce
+    _melhor_nonce = melhor_nonce
+
+
+def _aquecer_worker():
+    """Tarefa vazia usada para iniciar os workers antes das medições"""
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def alvo_para_bits(difficulty_bits):
+    """Retorna o alvo de 32 bytes: um digest é válido se for menor que ele"""
+    if difficulty_bits <= 0:
+        # Maior que qualquer digest de 32 bytes
+        return b'\xff' * 33
+    return (1 << (256 - difficulty_bits)).to_bytes(32, 'big')
+
+
+def atende_dificuldade(digest, difficulty_bits):
+    """Verifica se o digest bruto começa com `difficulty_bits` bits zero"""
+    return digest < alvo_para_bits(difficulty_bits)
+
+
+def _minerar_intervalo(prefixo, inicio, fim, difficulty_bits):
+    """Testa os nonces de [inicio, fim) sobre a cópia local do cabeçalho do bloco.
+
+    Retorna (tentativas, (nonce, hash)) ou (tentativas, None).
+    """
+    # Estado do SHA-256 já alimentado com a parte fixa do bloco
+    base = hashlib.sha256(prefixo)
+    alvo = alvo_para_bits(difficulty_bits)
+    for nonce in range(inicio, fim):
+        # Cancelar se outro worker já achou um nonce menor
+        if nonce % INTERVALO_VERIFICACAO == 0 and nonce > _melhor_nonce.value:
+            return nonce - inicio, None
+
+        sha = base.copy()
+        sha.update(b'%d' % nonce)
+        if sha.digest() < alvo:
+            with _melhor_nonce.get_lock():
+                if nonce < _melhor_nonce.value:
+                    _melhor_nonce.value = nonce
+            return nonce - inicio + 1, (nonce, sha.hexdigest())
+    return fim - inicio, None
+
+
+def _minerar_no_pool(pool, melhor_nonce, num_workers, prefixo, difficulty_bits, inicio, fim,
+                     estatisticas=None, cancelado=None):
+    """Envia intervalos de nonces ao pool até achar o menor nonce válido.
+
+    Com `fim=None` o espaço de nonces é ilimitado: novos intervalos são
+    gerados até haver solução ou até o evento `cancelado` ser sinalizado.
+    """
+    melhor_nonce.value = SEM_SOLUCAO
+    tentativas = 0
+    if fim is None:
+        intervalos = itertools.count(inicio, TAMANHO_INTERVALO)
+    else:
+        intervalos = iter(range(inicio, fim, TAMANHO_INTERVALO))
+    pendentes = {}
+    resultado = None
+
+    def enviar_intervalos():
+        # Manter todos os workers ocupados sem enfileirar o espaço inteiro
+        while len(pendentes) < 2 * num_workers:
+            if cancelado is not None and cancelado.is_set():
+                return
+            intervalo_inicio = next(intervalos, None)
+            if intervalo_inicio is None:
+                return
+            # Intervalos acima da solução atual não podem melhorá-la
+            if resultado and intervalo_inicio > resultado[0]:
+                return
+            intervalo_fim = intervalo_inicio + TAMANHO_INTERVALO
+            if fim is not None:
+                intervalo_fim = min(intervalo_fim, fim)
+            future = pool.submit(_minerar_intervalo, prefixo, intervalo_inicio, intervalo_fim, difficulty_bits)
+            pendentes[future] = intervalo_inicio
+
+    enviar_intervalos()
+    while pendentes:
+        concluidos, _ = wait(pendentes, return_when=FIRST_COMPLETED)
+        for future in concluidos:
+            del pendentes[future]
+            tentativas_intervalo, encontrado = future.result()
+            tentativas += tentativas_intervalo
+            if encontrado and (resultado is None or encontrado[0] < resultado[0]):
+                resultado = encontrado
+        enviar_intervalos()
+
+    if estatisticas is not None:
+        estatisticas['tentativas'] = tentativas
+    return resultado
+
+
+class MiningPool:
+    """Pool de workers reaproveitado em várias buscas de nonce.
+
+    `aquecer()` inicia todos os workers de uma vez, para que o custo de
+    criar os processos fique fora da primeira busca (ex.: no benchmark).
+    Pode ser usado como gerenciador de contexto.
+    """
+
+    def __init__(self, num_workers=None, estrategia='processos'):
+        if estrategia not in ESTRATEGIAS:
+            raise ValueError(f"Estratégia de mineração desconhecida: {estrategia}")
+        if estrategia == 'serial':
+            num_workers = 1
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.estrategia = estrategia
+        contexto = contexto_processos()
+        self._melhor_nonce = contexto.Value('q', SEM_SOLUCAO)
+        if estrategia == 'processos':
+            self._pool = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=contexto,
+                                             initializer=_inicializar_worker, initargs=(self._melhor_nonce,))
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.num_workers,
+                                            initializer=_inicializar_worker, initargs=(self._melhor_nonce,))
+
+    def aquecer(self):
+        """Inicia todos os workers e espera que estejam prontos"""
+        futures = [self._pool.submit(_aquecer_worker) for _ in range(self.num_workers)]
+        for future in futures:
+            future.result()
+
+    def minerar(self, prefixo, difficulty_bits, inicio=0, fim=None, estatisticas=None):
+        """Mesmo contrato de minerar(), usando os workers deste pool"""
+        return _minerar_no_pool(self._pool, self._melhor_nonce, self.num_workers,
+                                prefixo, difficulty_bits, inicio, fim, estatisticas)
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def minerar(prefixo, difficulty_bits, num_workers=None, inicio=0, fim=None,
+            estrategia='processos', estatisticas=None):
+    """Distribui intervalos de nonces entre workers e retorna (nonce, hash) ou None.
+
+    O resultado é sempre o menor nonce válido do intervalo, igual ao de uma
+    busca sequencial, independente da ordem em que os workers terminam.
+    Sem `fim`, a busca continua até encontrar uma solução.
+    `estrategia` escolhe 'processos', 'threads' ou 'serial' (uma única thread);
+    se `estatisticas` for um dict, recebe a quantidade de hashes calculados.
+    Usa um pool temporário; na aplicação prefira get_mining_service().
+    """
+    with MiningPool(num_workers, estrategia) as pool:
+        return pool.minerar(prefixo, difficulty_bits, inicio, fim, estatisticas)
+
+
+class MiningService:
+    """Serviço de mineração de longa duração compartilhado pelo processo.
+
+    Mantém um pool fixo de processos para o hash e uma fila limitada de
+    trabalhos (cadastros) consumida por uma única thread, de modo que os
+    blocos são minerados um de cada vez e em ordem.
+    """
+
+    def __init__(self, num_workers=None, tamanho_fila=100, tempo_espera_fila=TEMPO_ESPERA_FILA):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.tempo_espera_fila = tempo_espera_fila
+        contexto = contexto_processos()
+        self._melhor_nonce = contexto.Value('q', SEM_SOLUCAO)
+        self._pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                         mp_context=contexto,
+                                         initializer=_inicializar_worker,
+                                         initargs=(self._melhor_nonce,))
+        # Apenas uma busca de nonce por vez usa o valor compartilhado
+        self._lock_mineracao = threading.Lock()
+        self._fila = queue.Queue(maxsize=tamanho_fila)
+        self._encerrado = False
+        # Interrompe buscas ilimitadas em andamento no encerramento
+        self._cancelado = threading.Event()
+        self._thread = threading.Thread(target=self._consumir_fila, name='mining-service', daemon=True)
+        self._thread.start()
+
+    def minerar(self, prefixo, difficulty_bits, inicio=0, fim=None, estatisticas=None):
+        """Mesmo contrato de minerar(), usando o pool persistente.
+
+        Retorna None se o serviço for encerrado antes de achar a solução.
+        """
+        with self._lock_mineracao:
+            return _minerar_no_pool(self._pool, self._melhor_nonce, self.num_workers,
+                                    prefixo, difficulty_bits, inicio, fim, estatisticas,
+                                    cancelado=self._cancelado)
+
+    def submit(self, fn, *args, timeout=None, **kwargs):
+        """Enfileira um trabalho e retorna um Future com o resultado.
+
+        Com a fila cheia, espera até `timeout` segundos por uma vaga (padrão:
+        `tempo_espera_fila`) e então lança queue.Full.
+        """
+        if self._encerrado:
+            raise RuntimeError('Serviço de mineração encerrado')
+        if timeout is None:
+            timeout = self.tempo_espera_fila
+        future = Future()
+        self._fila.put((future, fn, args, kwargs), timeout=timeout)
+        return future
+
+    def _consumir_fila(self):
+        while True:
+            trabalho = self._fila.get()
+            if trabalho is None:
+                return
+            future, fn, args, kwargs = trabalho
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self, wait=True, cancelar=False):
+        """Encerra a fila e o pool de processos.
+
+        Por padrão os trabalhos já enfileirados são concluídos; com
+        `cancelar=True` as buscas em andamento são interrompidas e os
+        trabalhos restantes falham sem gravar blocos.
+        """
+        if self._encerrado:
+            return
+        self._encerrado = True
+        if cancelar:
+            self._cancelado.set()
+        self._fila.put(None)
+        if wait:
+            self._thread.join()
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_mining_service():
+    """Retorna o serviço de mineração do processo, criando-o na primeira chamada"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            num_workers = int(os.getenv('MINING_WORKERS', 0)) or None
+            tamanho_fila = int(os.getenv('MINING_QUEUE_SIZE', 100))
+            tempo_espera_fila = float(os.getenv('MINING_QUEUE_TIMEOUT', TEMPO_ESPERA_FILA))
+            _service = MiningService(num_workers, tamanho_fila, tempo_espera_fila)
+            # Na saída do interpretador não esperar buscas que podem não terminar
+            atexit.register(shutdown_mining_service, cancelar=True)
+        return _service
+
+
+def shutdown_mining_service(wait=True, cancelar=False):
+    """Encerra o serviço de mineração do processo, se existir"""
+    global _service
+    with _service_lock:
+        service = _service
+    if service is None:
+        return
+    # O serviço continua registrado durante o encerramento para que os
+    # trabalhos ainda na fila usem o mesmo pool em vez de criar outro
+    service.shutdown(wait=wait, cancelar=cancelar)
+    with _service_lock:
+        if _service is service:
+            _service = None
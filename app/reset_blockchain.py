@@ -22,6 +22,11 @@ def reset_blockchain():
     # Drop the blockchain collection
     try:
         db.blockchain.drop()
+        # O checkpoint de validação se refere à chain removida
+        db.blockchain_meta.drop()
+        # Auditorias guardadas também se referem à chain removida
+        db.blockchain_auditorias.drop()
+        db.blockchain_auditoria_erros.drop()
         print("✅ Coleção blockchain foi removida com sucesso!")
         print("A blockchain será reiniciada a partir do bloco genesis quando o aplicativo for iniciado.")
     except Exception as e:
@@ -0,0 +1,63 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Entradas guardadas antes de descartar as usadas há mais tempo
+TAMANHO_CACHE_PADRAO = 256
+# Segundos até uma entrada ser gerada de novo (0 = só na invalidação)
+VALIDADE_CACHE_PADRAO = 30
+
+
+class ResponseCache:
+    """Cache LRU de respostas já montadas, invalidado por alterações na coleção.
+
+    `invalidate()` descarta tudo e avança a versão do cache: um valor gerado
+    enquanto a coleção mudava não é guardado, para não sobreviver à
+    alteração. `get_json` guarda o corpo já codificado junto com um ETag
+    forte (hash do conteúdo), de modo que uma resposta repetida não faz
+    consulta nem codificação. Alterações feitas por outros processos não
+    passam por `invalidate()`, então cada entrada vale no máximo `validade`
+    segundos.
+    """
+
+    def __init__(self, tamanho_maximo=TAMANHO_CACHE_PADRAO, validade=VALIDADE_CACHE_PADRAO):
+        self.tamanho_maximo = tamanho_maximo
+        self.validade = validade
+        self._entradas = OrderedDict()
+        self._versao = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._versao += 1
+            self._entradas.clear()
+
+    def get(self, chave, gerar):
+        """Valor guardado para a chave, ou o resultado de gerar() (guardado)"""
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is not None:
+                valor, gerado_em = entrada
+                if not self.validade or time.monotonic() - gerado_em < self.validade:
+                    self._entradas.move_to_end(chave)
+                    return valor
+                del self._entradas[chave]
+            versao = self._versao
+        gerado_em = time.monotonic()
+        valor = gerar()
+        if self.tamanho_maximo <= 0:
+            return valor
+        with self._lock:
+            if versao == self._versao:
+                self._entradas[chave] = (valor, gerado_em)
+                while len(self._entradas) > self.tamanho_maximo:
+                    self._entradas.popitem(last=False)
+        return valor
+
+    def get_json(self, chave, gerar):
+        """(corpo, etag) da chave; gerar() devolve o corpo JSON em bytes"""
+        def codificar():
+            corpo = gerar()
+            return corpo, hashlib.sha256(corpo).hexdigest()[:32]
+        return self.get(chave, codificar)
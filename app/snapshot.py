@@ -0,0 +1,344 @@
+# Snapshot binário da blockchain: exportação, importação e verificação offline.
+#
+# Formato do arquivo (inteiros big-endian):
+#   cabeçalho   magic "EBCSNAP1", versão do formato, tamanho do registro,
+#               quantidade de blocos e offsets das três seções seguintes
+#   registros   um registro de largura fixa por bloco: índice, nonce,
+#               timestamp (microssegundos), dificuldade, versão, flags,
+#               hash e hash anterior em 32 bytes
+#   payloads    JSON de cada bloco: dados do estabelecimento, valores que não
+#               cabem no registro e demais campos do documento
+#   tabela      quantidade + 1 offsets (8 bytes) do payload de cada bloco
+#
+# A verificação usa mmap e não precisa do MongoDB: os registros bastam para
+# conferir os encadeamentos e a prova de trabalho; com os payloads o hash de
+# cada bloco também é recalculado.
+#
+# Exemplos:
+#   python app/snapshot.py export chain.snap
+#   python app/snapshot.py verify chain.snap --headers-only
+#   python app/snapshot.py import chain.snap --replace
+import argparse
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+
+import mining
+from chain_store import codificar_hash, codificar_timestamp, decodificar_timestamp
+
+MAGIC = b'EBCSNAP1'
+VERSAO_FORMATO = 1
+CABECALHO = struct.Struct('>8sHHQQQQ')
+REGISTRO = struct.Struct('>qqqBBBB32s32s')
+OFFSET = struct.Struct('>Q')
+
+# O payload traz valores que não couberam no registro de largura fixa
+FLAG_IRREGULAR = 1
+
+# Campos do bloco guardados no registro; os demais campos do documento vão no payload
+CAMPOS_BLOCO = ('index', 'timestamp', 'establishment_data', 'previous_hash', 'nonce',
+                'hash', 'difficulty_bits', 'version')
+
+
+def _codificar_bloco(documento):
+    """Converte um documento de bloco em (registro, payload)"""
+    irregulares = {}
+    digest = codificar_hash(documento['hash'])
+    if digest is None:
+        irregulares['hash'] = documento['hash']
+    anterior = codificar_hash(documento['previous_hash'])
+    if anterior is None:
+        irregulares['previous_hash'] = documento['previous_hash']
+    micros = codificar_timestamp(documento['timestamp'])
+    if micros is None:
+        irregulares['timestamp'] = documento['timestamp']
+    nonce = documento['nonce']
+    if type(nonce) is not int or not -2 ** 63 <= nonce < 2 ** 63:
+        irregulares['nonce'] = nonce
+        nonce = 0
+    bits = documento['difficulty_bits']
+    if type(bits) is not int or not 0 <= bits < 256:
+        irregulares['difficulty_bits'] = bits
+        bits = 0
+    versao = documento['version']
+    if type(versao) is not int or not 0 <= versao < 256:
+        irregulares['version'] = versao
+        versao = 0
+
+    registro = REGISTRO.pack(
+        documento['index'], nonce, micros or 0, bits, versao,
+        FLAG_IRREGULAR if irregulares else 0, 0,
+        digest or bytes(32), anterior or bytes(32)
+    )
+    conteudo = {'establishment_data': documento['establishment_data']}
+    if irregulares:
+        conteudo['irregulares'] = irregulares
+    extras = {chave: valor for chave, valor in documento.items()
+              if chave not in CAMPOS_BLOCO and chave != '_id'}
+    if extras:
+        conteudo['extras'] = extras
+    # Sem ordenar as chaves: blocos da versão 1 dependem do repr dos dados
+    payload = json.dumps(conteudo, ensure_ascii=False, default=str).encode('utf-8')
+    return registro, payload
+
+
+class SnapshotReader:
+    """Leitura de um snapshot mapeado em memória (mmap)"""
+
+    def __init__(self, caminho):
+        self._arquivo = open(caminho, 'rb')
+        try:
+            if os.fstat(self._arquivo.fileno()).st_size < CABECALHO.size:
+                raise ValueError(f'{caminho} não é um snapshot da blockchain')
+            self._mapa = mmap.mmap(self._arquivo.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._arquivo.close()
+            raise
+        magic, versao, tamanho_registro, self.quantidade, self._offset_registros, \
+            self._offset_payloads, self._offset_tabela = CABECALHO.unpack_from(self._mapa, 0)
+        erro = None
+        if magic != MAGIC:
+            erro = f'{caminho} não é um snapshot da blockchain'
+        elif versao != VERSAO_FORMATO or tamanho_registro != REGISTRO.size:
+            erro = f'Versão de snapshot não suportada: {versao}'
+        elif self._offset_tabela + (self.quantidade + 1) * OFFSET.size > len(self._mapa):
+            erro = f'Snapshot {caminho} incompleto'
+        if erro:
+            self.close()
+            raise ValueError(erro)
+
+    def __len__(self):
+        return self.quantidade
+
+    def registro(self, posicao):
+        """(index, nonce, micros, bits, versão, flags, reservado, hash, hash anterior) do bloco"""
+        return REGISTRO.unpack_from(self._mapa, self._offset_registros + posicao * REGISTRO.size)
+
+    def payload(self, posicao):
+        """Conteúdo JSON do bloco (dados do estabelecimento e campos extras)"""
+        inicio, = OFFSET.unpack_from(self._mapa, self._offset_tabela + posicao * OFFSET.size)
+        fim, = OFFSET.unpack_from(self._mapa, self._offset_tabela + (posicao + 1) * OFFSET.size)
+        return json.loads(self._mapa[self._offset_payloads + inicio:self._offset_payloads + fim])
+
+    def cabecalho(self, posicao):
+        """Campos do bloco necessários para encadeamento e prova de trabalho.
+
+        Só lê o payload quando o registro tem valores irregulares.
+        """
+        index, nonce, micros, bits, versao, flags, _, digest, anterior = self.registro(posicao)
+        campos = {
+            'index': index,
+            'hash': digest.hex(),
+            'previous_hash': anterior.hex(),
+            'difficulty_bits': bits,
+            'version': versao
+        }
+        if flags & FLAG_IRREGULAR:
+            irregulares = self.payload(posicao).get('irregulares', {})
+            campos.update((chave, irregulares[chave]) for chave in campos if chave in irregulares)
+        return campos
+
+    def documento(self, posicao):
+        """Reconstrói o documento completo do bloco, como salvo no MongoDB"""
+        index, nonce, micros, bits, versao, flags, _, digest, anterior = self.registro(posicao)
+        conteudo = self.payload(posicao)
+        documento = dict(conteudo.get('extras', {}))
+        documento.update({
+            'index': index,
+            'timestamp': decodificar_timestamp(micros),
+            'establishment_data': conteudo['establishment_data'],
+            'previous_hash': anterior.hex(),
+            'nonce': nonce,
+            'hash': digest.hex(),
+            'difficulty_bits': bits,
+            'version': versao
+        })
+        documento.update(conteudo.get('irregulares', {}))
+        return documento
+
+    def documentos(self, inicio=0):
+        for posicao in range(inicio, self.quantidade):
+            yield self.documento(posicao)
+
+    def close(self):
+        self._mapa.close()
+        self._arquivo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traceback):
+        self.close()
+        return False
+
+
+def write_snapshot(caminho, documentos, quantidade):
+    """Grava `quantidade` documentos de bloco (em ordem de índice) no arquivo"""
+    offset_registros = CABECALHO.size
+    offset_payloads = offset_registros + quantidade * REGISTRO.size
+    offsets = array('Q', [0])
+    # Gravar em arquivo temporário e renomear: um snapshot nunca fica pela metade
+    temporario = caminho + '.tmp'
+    with open(temporario, 'wb') as arquivo, tempfile.TemporaryFile() as registros:
+        arquivo.seek(offset_payloads)
+        escritos = 0
+        for documento in documentos:
+            if escritos == quantidade:
+                break
+            registro, payload = _codificar_bloco(documento)
+            registros.write(registro)
+            arquivo.write(payload)
+            offsets.append(offsets[-1] + len(payload))
+            escritos += 1
+        if escritos != quantidade:
+            raise RuntimeError(f'Esperados {quantidade} blocos, lidos {escritos}')
+
+        offset_tabela = offset_payloads + offsets[-1]
+        if sys.byteorder == 'little':
+            offsets.byteswap()
+        arquivo.write(offsets.tobytes())
+        arquivo.seek(0)
+        arquivo.write(CABECALHO.pack(MAGIC, VERSAO_FORMATO, REGISTRO.size, quantidade,
+                                     offset_registros, offset_payloads, offset_tabela))
+        registros.seek(0)
+        shutil.copyfileobj(registros, arquivo)
+    os.replace(temporario, caminho)
+
+
+def export_snapshot(collection, caminho):
+    """Exporta os blocos minerados da coleção para um snapshot; retorna a quantidade"""
+    ultimo = collection.find_one({'hash': {'$exists': True}}, {'index': 1}, sort=[('index', -1)])
+    if ultimo is None:
+        raise RuntimeError('A blockchain está vazia')
+    # Blocos minerados durante a exportação ficam para o próximo snapshot
+    filtro = {'hash': {'$exists': True}, 'index': {'$lte': ultimo['index']}}
+    quantidade = collection.count_documents(filtro)
+
+    # Importado aqui: establishment_blockchain também usa este módulo
+    from establishment_blockchain import Block
+
+    def normalizar(documentos):
+        for documento in documentos:
+            # Preencher campos com os padrões dos blocos antigos (versão e dificuldade)
+            block = Block.from_document(documento)
+            documento['difficulty_bits'] = block.difficulty_bits
+            documento['version'] = block.version
+            yield documento
+
+    write_snapshot(caminho, normalizar(collection.find(filtro).sort('index')), quantidade)
+    return quantidade
+
+
+def import_snapshot(caminho, collection, batch_size=1000, substituir=False):
+    """Grava os blocos do snapshot na coleção; retorna a quantidade importada"""
+    from bulk_writer import BulkWriter, imprimir_progresso
+
+    if collection.count_documents({'hash': {'$exists': True}}, limit=1):
+        if not substituir:
+            raise RuntimeError('A coleção já tem blocos; use substituir=True para apagá-los')
+        collection.delete_many({})
+    with SnapshotReader(caminho) as leitor:
+        with BulkWriter(collection, batch_size, ordered=False, progresso=imprimir_progresso,
+                        total=len(leitor)) as writer:
+            for documento in leitor.documentos():
+                writer.insert_one(documento)
+        return len(leitor)
+
+
+def verify_snapshot(caminho, min_difficulty_bits=0, somente_cabecalhos=False):
+    """Verifica o snapshot sem MongoDB; retorna (erros, índices adulterados).
+
+    Com `somente_cabecalhos` confere apenas os encadeamentos e a prova de
+    trabalho pelos registros de largura fixa, sem ler os payloads.
+    """
+    # Importado aqui: establishment_blockchain também usa este módulo
+    from establishment_blockchain import Block, block_validation_errors, required_difficulty_bits
+
+    errors = []
+    tampered_blocks = []
+    with SnapshotReader(caminho) as leitor:
+        if not len(leitor):
+            return errors, tampered_blocks
+        if somente_cabecalhos:
+            anterior = leitor.cabecalho(0)
+            for posicao in range(1, len(leitor)):
+                campos = leitor.cabecalho(posicao)
+                block_errors = []
+                if campos['previous_hash'] != anterior['hash']:
+                    block_errors.append(f"Bloco #{campos['index']}: Referência ao hash anterior inválida.")
+                try:
+                    digest = bytes.fromhex(campos['hash'])
+                except (TypeError, ValueError):
+                    digest = b''
+                # Mesma regra da validação completa: blocos da versão 1 têm alvo fixo
+                minimo_bits = required_difficulty_bits(campos['version'], min_difficulty_bits)
+                if campos['difficulty_bits'] < minimo_bits or len(digest) != 32 or \
+                        not mining.atende_dificuldade(digest, campos['difficulty_bits']):
+                    block_errors.append(f"Bloco #{campos['index']}: Prova de trabalho inválida.")
+                    block_errors.append(f"  - Dificuldade registrada: {campos['difficulty_bits']} bits "
+                                        f"(mínimo {minimo_bits})")
+                if block_errors:
+                    errors.extend(block_errors)
+                    tampered_blocks.append(campos['index'])
+                anterior = campos
+        else:
+            previous_hash = leitor.cabecalho(0)['hash']
+            for posicao in range(1, len(leitor)):
+                block = Block.from_document(leitor.documento(posicao))
+                block_errors = block_validation_errors(block, previous_hash, min_difficulty_bits)
+                if block_errors:
+                    errors.extend(block_errors)
+                    tampered_blocks.append(block.index)
+                previous_hash = block.hash
+    return errors, tampered_blocks
+
+
+def _colecao():
+    """Coleção da blockchain configurada no .env"""
+    from establishment_blockchain import connect_database
+    return connect_database()['blockchain']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot binário da blockchain')
+    comandos = parser.add_subparsers(dest='comando', required=True)
+
+    exportar = comandos.add_parser('export', help='grava a chain do MongoDB em um snapshot')
+    exportar.add_argument('arquivo')
+
+    importar = comandos.add_parser('import', help='grava os blocos do snapshot no MongoDB')
+    importar.add_argument('arquivo')
+    importar.add_argument('--replace', action='store_true', help='apaga a coleção blockchain antes')
+    importar.add_argument('--batch-size', type=int, default=int(os.getenv('BLOCKCHAIN_BULK_BATCH_SIZE', 1000)))
+
+    verificar = comandos.add_parser('verify', help='verifica o snapshot sem MongoDB')
+    verificar.add_argument('arquivo')
+    verificar.add_argument('--min-bits', type=int, default=int(os.getenv('BLOCKCHAIN_MIN_DIFFICULTY_BITS', 16)),
+                           help='dificuldade mínima aceita')
+    verificar.add_argument('--headers-only', action='store_true',
+                           help='confere só encadeamento e prova de trabalho, sem recalcular os hashes')
+    args = parser.parse_args()
+
+    if args.comando == 'export':
+        quantidade = export_snapshot(_colecao(), args.arquivo)
+        print(f"{quantidade} blocos exportados para {args.arquivo}")
+    elif args.comando == 'import':
+        quantidade = import_snapshot(args.arquivo, _colecao(), args.batch_size, args.replace)
+        print(f"{quantidade} blocos importados de {args.arquivo}")
+    else:
+        errors, tampered_blocks = verify_snapshot(args.arquivo, args.min_bits, args.headers_only)
+        for error in errors:
+            print(error)
+        if tampered_blocks:
+            print(f"Snapshot inválido: {len(tampered_blocks)} blocos com problemas")
+            sys.exit(1)
+        print("Snapshot válido")
+
+
+if __name__ == "__main__":
+    main()
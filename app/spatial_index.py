@@ -0,0 +1,261 @@
+import math
+import threading
+import time
+
+# Raio médio da Terra em quilômetros
+RAIO_TERRA_KM = 6371
+# Quilômetros por grau de latitude
+KM_POR_GRAU = math.pi * RAIO_TERRA_KM / 180
+
+# Distância mínima entre estabelecimentos cadastrados, em km
+DISTANCIA_MINIMA_KM = 2
+# Lado padrão das células da grade, em km (igual à distância mínima entre cadastros)
+TAMANHO_CELULA_KM = DISTANCIA_MINIMA_KM
+# Campos lidos da coleção para o índice
+PROJECAO_PONTO = {'nome': 1, 'latitude': 1, 'longitude': 1}
+
+
+# Fórmula de Haversine para calcular distância entre dois pontos em km
+def calcular_distancia(lat1, lon1, lat2, lon2):
+    lat1_rad = math.radians(lat1)
+    lon1_rad = math.radians(lon1)
+    lat2_rad = math.radians(lat2)
+    lon2_rad = math.radians(lon2)
+
+    dlon = lon2_rad - lon1_rad
+    dlat = lat2_rad - lat1_rad
+
+    a = math.sin(dlat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon/2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+
+    return RAIO_TERRA_KM * c
+
+
+class SpatialIndex:
+    """Índice em memória das coordenadas dos estabelecimentos.
+
+    Os pontos ficam em uma grade de células de `tamanho_celula_km` de lado
+    (em graus de latitude); uma busca por raio só examina as células que
+    cruzam o retângulo em volta do círculo. O MongoDB continua sendo a fonte
+    da verdade: o índice é carregado da coleção, atualizado pelas rotas que
+    inserem e excluem, opcionalmente por change stream, e recarregado por
+    inteiro a cada `intervalo_recarga` segundos (0 = nunca), para enxergar
+    cadastros feitos por outros processos. `ao_alterar()` é chamado depois de
+    cada alteração no índice.
+
+    Como o índice pode não ter visto cadastros de outros processos,
+    `name_taken` e `occupied_within` confirmam na coleção toda resposta
+    negativa antes de um cadastro ser aceito.
+    """
+
+    def __init__(self, collection, tamanho_celula_km=TAMANHO_CELULA_KM, intervalo_recarga=0, ao_alterar=None):
+        self.collection = collection
+        self.ao_alterar = ao_alterar
+        self.graus_celula = tamanho_celula_km / KM_POR_GRAU
+        self.colunas = math.ceil(360 / self.graus_celula)
+        self.intervalo_recarga = intervalo_recarga
+        self._lock = threading.RLock()
+        # célula -> {id: (nome, latitude, longitude)}
+        self._celulas = {}
+        # id -> (nome, latitude, longitude, célula)
+        self._pontos = {}
+        self._ids_por_nome = {}
+        self._carregado_em = 0
+
+    def __len__(self):
+        return len(self._pontos)
+
+    def _celula(self, latitude, longitude):
+        linha = math.floor((latitude + 90) / self.graus_celula)
+        coluna = math.floor((longitude + 180) / self.graus_celula) % self.colunas
+        return linha, coluna
+
+    def load(self):
+        """Recarrega todos os pontos da coleção"""
+        celulas, pontos, ids_por_nome = {}, {}, {}
+        cursor = self.collection.find({}, PROJECAO_PONTO)
+        for documento in cursor:
+            if documento.get('latitude') is None or documento.get('longitude') is None:
+                continue
+            identificador = str(documento['_id'])
+            nome, latitude, longitude = documento.get('nome'), documento['latitude'], documento['longitude']
+            celula = self._celula(latitude, longitude)
+            celulas.setdefault(celula, {})[identificador] = (nome, latitude, longitude)
+            pontos[identificador] = (nome, latitude, longitude, celula)
+            ids_por_nome[nome] = identificador
+        with self._lock:
+            self._celulas, self._pontos, self._ids_por_nome = celulas, pontos, ids_por_nome
+            self._carregado_em = time.monotonic()
+        self._notificar()
+        print(f"Índice espacial carregado com {len(pontos)} estabelecimentos")
+
+    def _recarregar_se_expirado(self):
+        if self.intervalo_recarga and time.monotonic() - self._carregado_em > self.intervalo_recarga:
+            self.load()
+
+    def _adicionar_documento(self, documento):
+        """Registra no índice um documento lido da coleção"""
+        if documento.get('latitude') is not None and documento.get('longitude') is not None:
+            self.add(documento['_id'], documento.get('nome'), documento['latitude'], documento['longitude'])
+
+    def add(self, identificador, nome, latitude, longitude):
+        """Registra (ou move) um estabelecimento no índice"""
+        identificador = str(identificador)
+        celula = self._celula(latitude, longitude)
+        with self._lock:
+            self._remover(identificador)
+            self._celulas.setdefault(celula, {})[identificador] = (nome, latitude, longitude)
+            self._pontos[identificador] = (nome, latitude, longitude, celula)
+            self._ids_por_nome[nome] = identificador
+        self._notificar()
+
+    def remove(self, identificador):
+        with self._lock:
+            self._remover(str(identificador))
+        self._notificar()
+
+    def _notificar(self):
+        if self.ao_alterar is not None:
+            self.ao_alterar()
+
+    def _remover(self, identificador):
+        ponto = self._pontos.pop(identificador, None)
+        if ponto is None:
+            return
+        nome, _, _, celula = ponto
+        celula_pontos = self._celulas.get(celula)
+        if celula_pontos is not None:
+            celula_pontos.pop(identificador, None)
+            if not celula_pontos:
+                del self._celulas[celula]
+        if self._ids_por_nome.get(nome) == identificador:
+            del self._ids_por_nome[nome]
+
+    def get_by_name(self, nome):
+        """(latitude, longitude) do estabelecimento com o nome, ou None"""
+        self._recarregar_se_expirado()
+        with self._lock:
+            identificador = self._ids_por_nome.get(nome)
+            if identificador is None:
+                return None
+            _, latitude, longitude, _ = self._pontos[identificador]
+            return latitude, longitude
+
+    def contains_name(self, nome):
+        return self.get_by_name(nome) is not None
+
+    def name_taken(self, nome):
+        """Indica se já existe um estabelecimento com o nome.
+
+        Se o índice não tem o nome, confirma na coleção; um documento
+        encontrado lá é registrado no índice.
+        """
+        if self.contains_name(nome):
+            return True
+        documento = self.collection.find_one({'nome': nome}, PROJECAO_PONTO)
+        if documento is None:
+            return False
+        self._adicionar_documento(documento)
+        return True
+
+    def occupied_within(self, latitude, longitude, raio_km):
+        """Indica se há algum estabelecimento a menos de `raio_km` do ponto.
+
+        Se o índice não tem nenhum, confirma na coleção com uma consulta
+        $near limitada a um documento; um documento encontrado lá é
+        registrado no índice.
+        """
+        if self.any_within(latitude, longitude, raio_km):
+            return True
+        documento = self.collection.find_one({
+            'localizacao': {
+                '$near': {
+                    '$geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+                    '$maxDistance': raio_km * 1000  # em metros
+                }
+            }
+        }, PROJECAO_PONTO)
+        if documento is None:
+            return False
+        self._adicionar_documento(documento)
+        return True
+
+    def _candidatos(self, latitude, longitude, raio_km):
+        """Pontos das células que cruzam o retângulo em volta do círculo.
+
+        Quando o retângulo tem mais células do que as ocupadas (raios grandes),
+        percorre as células ocupadas em vez das do retângulo, para o custo não
+        crescer com o quadrado do raio.
+        """
+        graus_lat = raio_km / KM_POR_GRAU
+        linha_min, _ = self._celula(max(latitude - graus_lat, -90), longitude)
+        linha_max, _ = self._celula(min(latitude + graus_lat, 90), longitude)
+        # A largura em longitude usa a latitude do retângulo mais próxima do polo
+        latitude_extrema = min(abs(latitude) + graus_lat, 90)
+        cosseno = math.cos(math.radians(latitude_extrema))
+        if cosseno * 360 * KM_POR_GRAU <= 2 * raio_km:
+            colunas = range(self.colunas)
+        else:
+            graus_lon = raio_km / (KM_POR_GRAU * cosseno)
+            _, coluna_min = self._celula(latitude, longitude - graus_lon)
+            largura = math.ceil(2 * graus_lon / self.graus_celula) + 1
+            colunas = [(coluna_min + deslocamento) % self.colunas
+                       for deslocamento in range(min(largura, self.colunas))]
+        linhas = range(linha_min, linha_max + 1)
+        if len(linhas) * len(colunas) > len(self._celulas):
+            colunas = set(colunas)
+            for (linha, coluna), celula in self._celulas.items():
+                if linha in linhas and coluna in colunas:
+                    yield from celula.items()
+            return
+        for linha in linhas:
+            for coluna in colunas:
+                celula = self._celulas.get((linha, coluna))
+                if celula:
+                    yield from celula.items()
+
+    def any_within(self, latitude, longitude, raio_km, excluir_nome=None):
+        """Indica se há algum estabelecimento a menos de `raio_km` do ponto"""
+        self._recarregar_se_expirado()
+        with self._lock:
+            for _, (nome, lat, lon) in self._candidatos(latitude, longitude, raio_km):
+                if nome != excluir_nome and calcular_distancia(latitude, longitude, lat, lon) <= raio_km:
+                    return True
+        return False
+
+    def within(self, latitude, longitude, raio_km, excluir_nome=None):
+        """Estabelecimentos a até `raio_km` do ponto, do mais próximo ao mais distante.
+
+        Cada resultado é um dict com nome, latitude, longitude e distancia (km).
+        """
+        self._recarregar_se_expirado()
+        resultados = []
+        with self._lock:
+            for _, (nome, lat, lon) in self._candidatos(latitude, longitude, raio_km):
+                if nome == excluir_nome:
+                    continue
+                distancia = calcular_distancia(latitude, longitude, lat, lon)
+                if distancia <= raio_km:
+                    resultados.append({'nome': nome, 'latitude': lat, 'longitude': lon, 'distancia': distancia})
+        resultados.sort(key=lambda resultado: resultado['distancia'])
+        return resultados
+
+    def watch_changes(self):
+        """Acompanha a coleção por change stream (requer replica set)"""
+        def acompanhar():
+            try:
+                with self.collection.watch(full_document='updateLookup') as stream:
+                    for change in stream:
+                        identificador = change['documentKey']['_id']
+                        documento = change.get('fullDocument')
+                        if change['operationType'] == 'delete' or not documento:
+                            self.remove(identificador)
+                        elif documento.get('latitude') is not None and documento.get('longitude') is not None:
+                            self.add(identificador, documento.get('nome'),
+                                     documento['latitude'], documento['longitude'])
+            except Exception as e:
+                print(f"Change stream dos estabelecimentos indisponível: {str(e)}")
+
+        thread = threading.Thread(target=acompanhar, name='estabelecimentos-change-stream', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+import merkle
+
+
+def registro(nome):
+    return {'establishment_id': nome, 'nome': nome, 'latitude': 0.0, 'longitude': 0.0}
+
+
+def test_registro_repetido_altera_a_raiz():
+    a, b, c = registro('a'), registro('b'), registro('c')
+    assert merkle.merkle_root([a, b, c]) != merkle.merkle_root([a, b, c, c])
+
+
+def test_provas_de_inclusao():
+    for quantidade in range(1, 12):
+        registros = [registro(str(i)) for i in range(quantidade)]
+        raiz = merkle.merkle_root(registros)
+        for posicao, atual in enumerate(registros):
+            prova = merkle.merkle_proof(registros, posicao)
+            assert merkle.verificar_prova(atual, prova, raiz, quantidade)
+            assert not merkle.verificar_prova(registro('x'), prova, raiz, quantidade)
+        prova = merkle.merkle_proof(registros, 0)
+        assert not merkle.verificar_prova(registros[0], prova, raiz, quantidade + 1)